@@ -0,0 +1,112 @@
+"""
+Measure the cost of importing the service and each report module in
+config.json, as paid on the cold start of a lambda, along with the imports
+that cost the most
+
+Each module is imported in fresh interpreters with `-X importtime`, and the
+median of the runs is reported. Run from the root of the repo with:
+
+    python -m benchmarks.cold_start [--runs N] [--output results.json]
+"""
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+RUNS = 5
+# Number of the most costly imports of each module to show
+TOP = 3
+
+
+def report_modules(config='config.json'):
+    """ List the service and the modules of the reports in a config """
+    with open(config) as f:
+        reports = json.load(f)['reports']
+    modules = ['service']
+    for report in reports:
+        if report['module'] not in modules:
+            modules.append(report['module'])
+    return modules
+
+
+def import_times(module):
+    """
+    Import a module in a fresh interpreter
+
+    :returns: The cumulative microseconds spent importing the module and
+        each module it imported directly, or None if it failed to import
+    """
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                           f'import {module}'],
+                          stderr=subprocess.PIPE, universal_newlines=True)
+    if proc.returncode != 0:
+        return None
+    # Nested imports are listed before the module that imported them, so
+    # collect direct imports until the module itself is listed, skipping
+    # those of the interpreter's own startup
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line.split('|')
+        if not cumulative.strip().isdigit():
+            continue
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 1:
+            times[name.strip()] = int(cumulative)
+        elif depth == 0:
+            if name.strip() == module:
+                times[module] = int(cumulative)
+                return times
+            times = {}
+    return None
+
+
+def measure(module, runs=RUNS):
+    """
+    Measure the import cost of a module over many runs
+
+    :returns: A dict of the median `total` milliseconds and the `top`
+        imports with the median milliseconds of each, or None if the module
+        failed to import
+    """
+    results = [import_times(module) for _ in range(runs)]
+    if any(r is None for r in results):
+        return None
+    deps = {name for r in results for name in r if name != module}
+    top = sorted(((name, statistics.median(r.get(name, 0) for r in results))
+                  for name in deps), key=lambda d: d[1], reverse=True)[:TOP]
+    return {
+        'total': statistics.median(r[module] for r in results) / 1000,
+        'top': {name: us / 1000 for name, us in top}
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('modules', nargs='*',
+                        help='Modules to measure, defaults to the service '
+                             'and every report in config.json')
+    parser.add_argument('--runs', type=int, default=RUNS)
+    parser.add_argument('--output', help='Save the results as json')
+    args = parser.parse_args()
+
+    results = {}
+    print(f'{"module":<24} {"import (ms)":>12}  slowest imports (ms)')
+    for module in args.modules or report_modules():
+        results[module] = measure(module, args.runs)
+        if results[module] is None:
+            print(f'{module:<24} {"failed":>12}')
+            continue
+        top = ', '.join(f'{name} {ms:.0f}'
+                        for name, ms in results[module]['top'].items())
+        print(f'{module:<24} {results[module]["total"]:>12.0f}  {top}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
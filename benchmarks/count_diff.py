@@ -0,0 +1,121 @@
+"""
+Benchmark the change report's count_diff against the row-at-a-time version it
+replaced, by the number of distinct values in the column, and the diffing of
+a whole summary by the number of processes it's diffed in
+
+Run from the root of the repo with:
+
+    python -m benchmarks.count_diff
+"""
+import os
+import time
+import numpy as np
+import pandas as pd
+
+from reports.change_report import ChangeGenerator, count_diff
+from reports.storage import MemoryStorage
+
+SIZES = [100, 1000, 10000, 100000]
+# Numbers of processes to diff a summary in
+DIFF_WORKERS = [1, 2, 4]
+# Columns in the summary diffed and distinct values in each of them
+COLUMNS = 40
+VALUES = 20000
+
+
+def legacy_count_diff(df1, df2):
+    """
+    count_diff as it was, formatting each row with DataFrame.apply
+    """
+    def diff_format(r):
+        return f"{int(r['count_2'])} ({int(r['change']):+})"
+
+    def diff_html(r):
+        change = f"{int(r['change']):+}"
+        color = ''
+        if r['change'] > 0:
+            color = 'text-success'
+        elif r['change'] < 0:
+            color = 'text-danger'
+        else:
+            color = 'text-color'
+        change = f'(<span class="{color}">{change}</span>)'
+        return f"{int(r['count_2'])} {change}"
+
+    diff = df2.merge(df1, how='outer', on=df1.columns[0],
+                     suffixes=['_2', '_1']).fillna(0)
+    diff['change'] = diff['count_2'] - diff['count_1']
+    diff['summary'] = diff.apply(diff_format, axis=1)
+    diff['summary_html'] = diff.apply(diff_html, axis=1)
+    diff = diff[diff['change'] != 0]
+    diff = diff.sort_values(['change', 'count_2'], ascending=False).reset_index(drop=True)
+    return diff
+
+
+def make_counts(size, seed):
+    """
+    Make the value counts of a column like external ids, where most values
+    are seen once and some values come and go between summaries
+    """
+    rng = np.random.RandomState(seed)
+    values = [f'EXT_{i}' for i in range(size)]
+    df = pd.DataFrame({'external_id': values,
+                       'count': rng.choice([1, 1, 1, 2, 3], size)})
+    return df.sample(frac=0.9, random_state=rng).reset_index(drop=True)
+
+
+def make_summary(seed):
+    """
+    Make a summary of COLUMNS columns of VALUES distinct values each
+    """
+    storage = MemoryStorage()
+    for i in range(COLUMNS):
+        counts = make_counts(VALUES, seed + i)
+        storage.write(f'table/column_{i}.csv',
+                      counts.rename(columns={'external_id': f'column_{i}'})
+                            .to_csv())
+    return storage
+
+
+def diff_summaries(summary_1, summary_2, workers):
+    """
+    Diff every column of two summaries in `workers` processes
+    """
+    g = ChangeGenerator(summary_1, summary_2, output=MemoryStorage(),
+                        diff_workers=workers)
+    return g.compute_diffs()[1]
+
+
+def timed(f, *args):
+    start = time.perf_counter()
+    result = f(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    print(f'{"values":>8} {"apply (s)":>10} {"vectorized (s)":>15} '
+          f'{"speedup":>8}')
+    for size in SIZES:
+        df1, df2 = make_counts(size, 1), make_counts(size, 2)
+        expected, legacy = timed(legacy_count_diff, df1.copy(), df2.copy())
+        result, vectorized = timed(count_diff, df1.copy(), df2.copy())
+        pd.testing.assert_frame_equal(result, expected)
+        print(f'{size:>8} {legacy:>10.3f} {vectorized:>15.3f} '
+              f'{legacy / vectorized:>7.1f}x')
+
+    # Processes only help when there are cores for them to run on
+    print(f'\ndiffing {COLUMNS} columns of {VALUES} values '
+          f'on {os.cpu_count()} cpus')
+    print(f'{"workers":>8} {"diff (s)":>10} {"speedup":>8}')
+    summary_1, summary_2 = make_summary(1), make_summary(1000)
+    serial = None
+    for workers in DIFF_WORKERS:
+        counts, elapsed = timed(diff_summaries, summary_1, summary_2, workers)
+        if serial is None:
+            expected, serial = counts, elapsed
+        assert counts == expected
+        print(f'{workers:>8} {elapsed:>10.3f} {serial / elapsed:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
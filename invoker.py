@@ -1,10 +1,11 @@
 import os
 import datetime
 import json
-from base64 import b64decode
 import boto3
 from botocore.vendored import requests
 
+from reports import credentials
+
 
 def handler(event, context):
     """
@@ -37,9 +38,8 @@ def handler(event, context):
 
     # Send slack message
     if 'SLACK_SECRET' in os.environ and 'SLACK_CHANNEL' in os.environ:
-        kms = boto3.client('kms', region_name='us-east-1')
         SLACK_SECRET = os.environ.get('SLACK_SECRET', None)
-        SLACK_TOKEN = kms.decrypt(CiphertextBlob=b64decode(SLACK_SECRET)).get('Plaintext', None).decode('utf-8')
+        SLACK_TOKEN = credentials.kms_decrypt(SLACK_SECRET)
         SLACK_CHANNEL = os.environ.get('SLACK_CHANNEL', '').split(',')
         SLACK_CHANNEL = [c.replace('#','').replace('@','') for c in SLACK_CHANNEL]
         TRACKER_URL = os.environ.get('REPORT_TRACKER', '')
@@ -1,8 +1,10 @@
-import boto3
+import io
 import os
 import re
-import glob
+import json
+import traceback
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
 import numpy as np
@@ -11,8 +13,17 @@ from collections import defaultdict
 
 from jinja2 import Environment, FileSystemLoader
 
+from reports import snapshot
+from reports.storage import get_storage, MemoryStorage
+from reports.pools import process_pool
+from reports.history import History
 
-DIFF_RE = re.compile(r'^(.*\()([+-]?\d+(\.\d+)?)\)$')
+
+# Files the change report reads from a summary directory, relative to it
+SUMMARY_RE = re.compile(r'^[^/]+/[^/]+\.csv$')
+SNAPSHOT_FILES = {snapshot.COUNTS_FILE, snapshot.DESCRIBE_FILE}
+# Number of files read at once from each remote summary directory
+DOWNLOAD_WORKERS = 16
 
 
 def handler(event, context):
@@ -29,8 +40,13 @@ def handler(event, context):
 
     Where `summary_path_1` and `summary_path_2` are the local, or s3 paths of
     the summary tables.
-    `output` is the local or s3 path to save the diff tables and report to.
+    `output` is the s3 path to save the diff tables and report to, without
+    the `s3://`. They are saved to the `local_output` directory instead, for
+    upload by the service, if it is given.
     `title` is a description of the report.
+    If a `history` path is given, the summaries of its `date_1` and `date_2`
+    are compared instead of the summary paths, falling back to the summary
+    path of any date the history doesn't have.
 
     We expect `summary_path` directories to be formatted as follows:
     ```
@@ -45,22 +61,37 @@ def handler(event, context):
       column_2.csv
       ...
     ```
+    or to hold a single snapshot of the summaries, as saved by the summary
+    report:
+    ```
+    snapshot.csv.gz
+    describe.csv.gz
+    ```
     """
     path_1 = event.get('summary_path_1')
     path_2 = event.get('summary_path_2')
+    if 'history' in event:
+        history = History(event['history'])
+        summary_1 = history.summary(event['date_1'])
+        summary_2 = history.summary(event['date_2'])
+        # Dates from before the history was kept are only in the summaries
+        path_1 = summary_1 if summary_1.list() else path_1
+        path_2 = summary_2 if summary_2.list() else path_2
     output = event.get('output', './output/')
-    local_output = event.get('local_output', '/tmp/')
+    local_output = event.get('local_output')
     title = event.get('title', '')
     subtitle = event.get('subtitle', 'Change Report')
 
-    g = ChangeGenerator(path_1, path_2, title=title, subtitle=subtitle)
+    g = ChangeGenerator(path_1, path_2,
+                        output=local_output or 's3://'+output,
+                        title=title, subtitle=subtitle,
+                        workers=event.get('download_workers',
+                                          DOWNLOAD_WORKERS),
+                        diff_workers=event.get('diff_workers', 1),
+                        chunksize=event.get('diff_chunksize', 1))
     diff_message = g.make_report()
     print(diff_message)
 
-    # Collect all files in ouput
-    files = set(glob.glob(local_output+'diffs/**/*.csv', recursive=True))
-    files = files.union(set(glob.glob(local_output+'**/*.html', recursive=True)))
-
     if len(diff_message) > 0:
         url = output
         url += f"/{title.lower().replace(' ', '_')}.html"
@@ -74,64 +105,138 @@ def handler(event, context):
             }
         ]
 
-    return diff_message, {p.replace('/tmp/', ''): p for p in list(files)}
+    return diff_message, {p: g.output.url(p) for p in g.output.written}
 
 
 class ChangeGenerator:
 
     def __init__(self, path_1, path_2, output='/tmp/',
-                 title='Change Report', subtitle=''):
+                 title='Change Report', subtitle='', workers=DOWNLOAD_WORKERS,
+                 diff_workers=1, chunksize=1):
         """
-        :param path_1: Path to directory of first summary files
-        :param path_2: Path to directory of second summary files
-        :param output: The directory to output all diff tables
+        :param path_1: Path or storage of the first summary files
+        :param path_2: Path or storage of the second summary files
+        :param output: The path or storage to output all diff tables to
+        :param workers: Number of files to read at once from each remote
+            summary directory
+        :param diff_workers: Number of processes to diff columns in
+        :param chunksize: Number of columns sent to a process at a time
         """
-        self.output = output
+        self.output = get_storage(output)
         self.title = title
         self.subtitle = subtitle
-        if 's3://' in path_1:
-            path_1 = self.download_summary(path_1, output=output+'summary_1/')
-        if 's3://' in path_2:
-            path_2 = self.download_summary(path_2, output=output+'summary_2/')
-
-        if not os.path.isdir(path_1) or not os.path.isdir(path_2):
+        self.workers = workers
+        self.diff_workers = diff_workers
+        self.chunksize = chunksize
+        # Errors of the columns that couldn't be diffed keyed by table and
+        # column
+        self.errors = {}
+        self.path_1 = get_storage(path_1)
+        self.path_2 = get_storage(path_2)
+        if not self.path_1.exists() or not self.path_2.exists():
             raise IOError(f'Please provide valid directory paths')
 
-        self.path_1 = path_1
-        self.path_2 = path_2
-        self.tables = self.compare_tables(path_1, path_2)
-        self.columns = self.compare_columns(path_1, path_2)
-
-    def download_summary(self, path, output='/tmp/'):
-        """ Download summary tables from s3 to local """
-        os.makedirs(output, exist_ok=True)
-        path = path.replace('s3://', '')
-        bucket = path.split('/')[0]
-        key = '/'.join(path.split('/')[1:])
-
-        client = boto3.client('s3')
-        paginator = client.get_paginator('list_objects')
-        paginator = paginator.paginate(Bucket=bucket, Prefix=key)
-        print(f'Downloading all summaries from {bucket}/{key}')
-
-        for page in paginator:
-            for obj in page['Contents']:
-                fname = '/'.join(obj['Key'].split('/')[-2:])
-                d = os.path.join(output, '/'.join(fname.split('/')[:-1]))
-                os.makedirs(d, exist_ok=True)
-                client.download_file(bucket,
-                                     obj['Key'],
-                                     os.path.join(output, fname))
-        return output
+        # Only columns whose digests differ need to be read and diffed
+        manifests = [self.load_manifest(self.path_1),
+                     self.load_manifest(self.path_2)]
+        changed = changed_columns(*manifests)
+
+        # Fetch both summaries at the same time
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            self.path_1, self.path_2 = pool.map(
+                lambda storage: self.load_summary(storage, changed),
+                [self.path_1, self.path_2])
+        self.manifests = {self.path_1: manifests[0],
+                          self.path_2: manifests[1]}
+        self.snapshots = {self.path_1: self.load_snapshot(self.path_1),
+                          self.path_2: self.load_snapshot(self.path_2)}
+        self.tables = self.compare_tables(self.path_1, self.path_2)
+        self.columns = self.compare_columns(self.path_1, self.path_2)
+
+    def load_summary(self, storage, changed=None):
+        """
+        Read a remote summary into memory
+
+        Only the files the change report reads are fetched: the snapshot if
+        the summary has one, otherwise the csv of every column, or of only
+        the `changed` (table, column) pairs if given. Local summaries are
+        read in place.
+        """
+        if not storage.remote:
+            return storage
+        print(f'Reading all summaries from {storage.url()}')
+        names = storage.list(recursive=True)
+        if SNAPSHOT_FILES.issubset(names):
+            names = sorted(SNAPSHOT_FILES)
+        elif changed is not None:
+            names = [f'{table}/{column}.csv' for table, column in changed
+                     if f'{table}/{column}.csv' in names]
+        else:
+            names = [n for n in names if SUMMARY_RE.match(n)]
+
+        memory = MemoryStorage()
+        memory.files.update(storage.read_many(names, self.workers))
+        return memory
+
+    def load_manifest(self, storage):
+        """
+        Load the digests of the summary csvs in a summary directory
+
+        Returns None if the summaries have no manifest.
+        """
+        manifest = storage.read(snapshot.MANIFEST_FILE)
+        return None if manifest is None else json.loads(manifest)
+
+    def load_snapshot(self, storage):
+        """
+        Load the snapshot in a summary directory
+
+        Returns None if the summaries are saved as a tree of csvs instead.
+        """
+        counts = storage.read(snapshot.COUNTS_FILE)
+        describe = storage.read(snapshot.DESCRIBE_FILE)
+        if counts is None or describe is None:
+            return None
+        return snapshot.read_snapshot(counts, describe)
+
+    def list_summaries(self, storage):
+        """ List the summarized columns of each table in a summary directory """
+        if self.manifests[storage] is not None:
+            return {table: list(columns)
+                    for table, columns in self.manifests[storage].items()}
+        if self.snapshots[storage] is not None:
+            return snapshot.list_columns(*self.snapshots[storage])
+        return {table[:-1]: [p.split('.')[0] for p in storage.list(table)]
+                for table in storage.list() if table.endswith('/')}
+
+    def read_summary(self, storage, table, column):
+        """
+        Read the value counts csv of a column, or the `summary` csv of its
+        table, from a summary directory
+        """
+        if self.snapshots[storage] is not None:
+            counts, describe = self.snapshots[storage]
+            if column == 'summary':
+                return (snapshot.table_describe(describe, table)
+                        .to_csv().encode())
+            return (snapshot.column_counts(counts, table, column)
+                    .to_csv().encode())
+        data = storage.read(f'{table}/{column}.csv')
+        if data is None:
+            raise FileNotFoundError(storage.url(f'{table}/{column}.csv'))
+        return data
 
     def make_report(self):
         diffs, counts = self.compute_diffs()
 
         # Styling of the diff tables
         for name, table in diffs.items():
-            if name == 'summary':
-                continue
             for col, column in table.items():
+                if col == 'summary':
+                    diffs[name][col] = (diffs[name][col]
+                        .style.set_table_attributes(
+                            'class="table table-striped table-hover"'))
+                    continue
                 diffs[name][col] = (diffs[name][col]
                         .drop(['count_2', 'change', 'summary', 'count_1'],
                               axis=1)
@@ -162,11 +267,18 @@ class ChangeGenerator:
         html_out = template.render(template_vars)
         title = self.title.lower().replace(' ', '_')
         filename = f"{title}.html"
-        with open(os.path.join(self.output, filename), "w+") as f:
-            f.write(html_out)
+        self.output.write(filename, html_out)
 
         # Create diff message
-        return self.diff_summary_message(counts)
+        message = self.diff_summary_message(counts)
+        if self.errors:
+            failed = ', '.join(f'{t}.{c}' for t, c in self.errors)
+            message.append({
+                "text": f"Couldn't compare {failed}",
+                "fallback": f"Couldn't compare {failed}",
+                "color": "danger",
+            })
+        return message
 
     def diff_summary_message(self, counts):
         """
@@ -197,39 +309,36 @@ class ChangeGenerator:
 
         return attachments
 
-    def compare_tables(self, path_1, path_2):
+    def compare_tables(self, summary_1, summary_2):
         """ Compare available tables between the two summaries """
-        tables_1 = set(os.listdir(path_1))
-        tables_2 = set(os.listdir(path_2))
+        tables_1 = set(self.list_summaries(summary_1))
+        tables_2 = set(self.list_summaries(summary_2))
         added = list(tables_2 - tables_1)
         deleted = list(tables_1 - tables_2)
         same = list(tables_1 & tables_2)
 
         return {'added': added, 'deleted': deleted, 'same': same}
 
-    def compare_columns(self, path_1, path_2):
+    def compare_columns(self, summary_1, summary_2):
         """ Compare available columns between the two summaries """
-        tables_1 = set(os.listdir(path_1))
-        tables_2 = set(os.listdir(path_2))
+        tables_1 = self.list_summaries(summary_1)
+        tables_2 = self.list_summaries(summary_2)
 
         columns = defaultdict(dict)
-        for table in tables_1 | tables_2:
+        for table in set(tables_1) | set(tables_2):
             columns[table]['added'] = []
             columns[table]['deleted'] = []
             columns[table]['same'] = []
 
-            def strip_exts(path):
-                return [p.split('.')[0] for p in os.listdir(path)]
-
-            if not os.path.isdir(os.path.join(path_1, table)):
-                columns[table]['added'] = strip_exts(path_2+'/'+table)
+            if table not in tables_1:
+                columns[table]['added'] = tables_2[table]
                 continue
-            elif not os.path.isdir(os.path.join(path_2, table)):
-                columns[table]['deleted'] = strip_exts(path_1+'/'+table)
+            elif table not in tables_2:
+                columns[table]['deleted'] = tables_1[table]
                 continue
 
-            col_1 = set(strip_exts(os.path.join(path_1, table)))
-            col_2 = set(strip_exts(os.path.join(path_2, table)))
+            col_1 = set(tables_1[table])
+            col_2 = set(tables_2[table])
             columns[table]['same'] = list(col_1 & col_2)
             columns[table]['added'] = list(col_2 - col_1)
             columns[table]['deleted'] = list(col_1 - col_2)
@@ -248,147 +357,199 @@ class ChangeGenerator:
         Looks through summary tables and computes diffs for each returning a
         dict of styled html tables organized by table and column and leaving
         out any summaries that did not change.
+
+        Columns with the same digest in both summaries' manifests are
+        counted as unchanged without being read. The `summary` of each table
+        is diffed stat by stat, and is not counted as a change to a column.
         """
+        changed = changed_columns(self.manifests[self.path_1],
+                                  self.manifests[self.path_2])
 
         tables = defaultdict(dict)
         # Also keep track of total number of changes per column
         counts = defaultdict(dict)
 
-        # Look through each table
-        for table, columns in self.columns.items():
-            out_dir = os.path.join(self.output, 'diffs', table)
-            os.makedirs(out_dir, exist_ok=True)
-            # Make diffs for each column that is shared between summaries
-            for column in columns['same']:
-                if column == 'summary':
-                    continue
-                df_1 = pd.read_csv(os.path.join(self.path_1,
-                                                table,
-                                                column+'.csv'),
-                                   index_col=0)
-                df_2 = pd.read_csv(os.path.join(self.path_2,
-                                                table,
-                                                column+'.csv'),
-                                   index_col=0)
-                if len(df_1) == 0 or len(df_2) == 0:
-                    continue
+        def jobs():
+            """ Read the summaries of each column that needs diffing """
+            for table, columns in self.columns.items():
+                # Make diffs for each column shared between summaries,
+                # starting with the table's summary
+                for column in sorted(columns['same'],
+                                     key=lambda c: c != 'summary'):
+                    if changed is not None and (table, column) not in changed:
+                        if column != 'summary':
+                            counts[table][column] = 0
+                        continue
+                    try:
+                        data_1 = self.read_summary(self.path_1, table, column)
+                        data_2 = self.read_summary(self.path_2, table, column)
+                    except Exception:
+                        self.errors[(table, column)] = traceback.format_exc()
+                        continue
+                    yield table, column, data_1, data_2
+
+        if self.diff_workers > 1:
+            with process_pool(self.diff_workers) as pool:
+                results = list(pool.map(diff_column, jobs(),
+                                        chunksize=self.chunksize))
+        else:
+            results = list(map(diff_column, jobs()))
+
+        # Results are in the same order as the columns were read
+        for table, column, diff, data, error in results:
+            if error is not None:
+                self.errors[(table, column)] = error
+                continue
+            if diff is None:
+                continue
+            tables[table][column] = diff
+            # Save diff
+            self.output.write(f'diffs/{table}/{column}_diff.csv', data)
+            if column == 'summary':
+                # Every table shown needs a row in the counts
+                counts.setdefault(table, {})
+                continue
+            # Update the counts
+            counts[table][column] = diff['change'].abs().sum()
 
-                tables[table][column] = self.count_diff(df_1, df_2)
-                # Save diff
-                out_path = os.path.join(out_dir, f'{column}_diff.csv')
-                tables[table][column].to_csv(out_path)
-                # Update the counts
-                counts[table][column] = (tables[table][column]['change']
-                                            .abs()
-                                            .sum())
+        for (table, column), error in self.errors.items():
+            print(f'Failed to diff {table}.{column}:\n{error}')
         return tables, counts
 
-        self.diff_counts = counts
-        return sections
 
-    def count_diff(self, df1, df2):
-        """
-        Compares two dataframes by converting to dicts
-        """
-        def diff_format(r):
-            return f"{int(r['count_2'])} ({int(r['change']):+})"
-
-        def diff_html(r):
-            """
-            Wraps values in span tags for display in web page
-            """
-            change = f"{int(r['change']):+}"
-            color = ''
-            if r['change'] > 0:
-                color = 'text-success'
-            elif r['change'] < 0:
-                color = 'text-danger'
-            else:
-                color = 'text-color'
-            change = f'(<span class="{color}">{change}</span>)'
-            return f"{int(r['count_2'])} {change}"
-
-        # Convert datetimes to strings
-        for c in df1.select_dtypes(include=[np.datetime64]):
-            df1[c] = df1[c].dt.strftime('%Y-%m-%d %H:%M:%S')
-
-        for c in df2.select_dtypes(include=[np.datetime64]):
-            df2[c] = df2[c].dt.strftime('%Y-%m-%d %H:%M:%S')
-
-        diff = df2.merge(df1, how='outer', on=df1.columns[0],
-                         suffixes=['_2', '_1']).fillna(0)
-        diff['change'] = diff['count_2'] - diff['count_1']
-        diff['summary'] = diff.apply(diff_format, axis=1)
-        diff['summary_html'] = diff.apply(diff_html, axis=1)
-        diff = diff[diff['change'] != 0]
-        diff = diff.sort_values(['change', 'count_2'], ascending=False).reset_index(drop=True)
-        #diff = diff.reset_index(drop=True)
-        return diff
-
-    def compute_diff(self, df1, df2):
-        """
-        Compares two dataframes
-        """
-        df = pd.concat([df1, df2], 
-                        axis='columns',
-                        keys=['DF1', 'DF2'])
-
-        diff = pd.DataFrame(columns=set(df.columns.get_level_values(1)))
-
-        for c in set(df.columns.get_level_values(1)):
-            if c not in df['DF1'].columns:
-                diff[c] = df['DF2'][c]
-            elif c not in df['DF2'].columns:
-                diff[c] = df['DF1'][c]
-            else:
-                diff[c] = df.xs(c, level=1, drop_level=1, axis=1) \
-                            .apply(self.differ, axis=1)
-            
-        return diff
-
-    def highlight_diff(self, value):
-        if value is None:
-            return value
-        
-        try:
-            m = DIFF_RE.match(str(value))
-            if m:
-                change = float(str(m.group(2)))
-            else:
-                return value
-
-            if change < 0:
-                r = DIFF_RE.sub(r"\1<span class='text-danger'>\2</span>)", value)
-                return r
-            elif change > 0:
-                r = DIFF_RE.sub(r"\1<span class='text-success'>\2</span>)", value)
-                return r
-            else:
-                return value
-        except ValueError as verr:
-            return value
-        return value
-
-    def differ(self, r):
-        """
-        Compares two values and returns the new value
-        """
-        first = r['DF1']
-        second = r['DF2']
-        try:
-            try:
-                first = int(str(first))
-                second = int(str(second))
-            except ValueError:
-                first = float(str(first))
-                second = float(str(second))
-        except ValueError as verr:
-            if str(first) != str(second):
-                return f'<span class="text-success">{first}</span> <span class="text-danger">(-{second})</span>'
-            else:
-                return first
-        return f'{first} ({(first - second):+})'
+def count_diff(df1, df2):
+    """
+    Compares the value counts of a column in two summaries
+
+    The change and its formatting are computed a column at a time, so
+    columns with many distinct values are diffed just as quickly.
+    """
+    # Convert datetimes to strings
+    for c in df1.select_dtypes(include=[np.datetime64]):
+        df1[c] = df1[c].dt.strftime('%Y-%m-%d %H:%M:%S')
+
+    for c in df2.select_dtypes(include=[np.datetime64]):
+        df2[c] = df2[c].dt.strftime('%Y-%m-%d %H:%M:%S')
+
+    diff = df2.merge(df1, how='outer', on=df1.columns[0],
+                     suffixes=['_2', '_1']).fillna(0)
+    diff['change'] = diff['count_2'] - diff['count_1']
+    # Only values that changed are reported, so only those are formatted
+    diff = diff[diff['change'] != 0]
+
+    count = diff['count_2'].astype('int64').astype(str)
+    change = diff['change'].astype('int64')
+    change = np.where(change >= 0, '+', '') + change.astype(str)
+    # Wrap changes in span tags for display in web page
+    color = np.select([diff['change'] > 0, diff['change'] < 0],
+                      ['text-success', 'text-danger'], 'text-color')
+    diff = diff.assign(
+        summary=count + ' (' + change + ')',
+        summary_html=(count + ' (<span class="' + color + '">' +
+                      change + '</span>)'))
+    diff = diff.sort_values(['change', 'count_2'], ascending=False).reset_index(drop=True)
+    return diff
+
+
+def describe_diff(df1, df2, html=True):
+    """
+    Compares the describe() summaries of a table in two summaries
+
+    Cells that are numbers in both summaries are shown with how much they
+    changed, and other cells with the value they had before if it changed.
+    Numbers are told apart from text by converting whole columns, rather
+    than by trying to parse each cell.
+
+    :param df1: The first summary with its cells as text
+    :param df2: The second summary with its cells as text
+    :param html: Whether to wrap changes in span tags for display in web
+        page
+    :returns: The second summary with the changes added to its cells, or
+        None if nothing changed
+    """
+    # Keep the order of the stats and columns of the second summary
+    index = list(df2.index) + [i for i in df1.index if i not in df2.index]
+    columns = (list(df2.columns) +
+               [c for c in df1.columns if c not in df2.columns])
+    old = df1.reindex(index=index, columns=columns).fillna('').stack()
+    new = df2.reindex(index=index, columns=columns).fillna('').stack()
+
+    numeric = (pd.to_numeric(old, errors='coerce').notnull() &
+               pd.to_numeric(new, errors='coerce').notnull())
+    change = (pd.to_numeric(new.where(numeric, '0')) -
+              pd.to_numeric(old.where(numeric, '0')))
+    changed = (numeric & (change != 0)) | (~numeric & (old != new))
+    if not changed.any():
+        return None
+
+    # Show whole changes as integers
+    text = change.round(6).astype(str).where(change % 1 != 0,
+                                             change.round().astype('int64')
+                                                   .astype(str))
+    text = np.where(change >= 0, '+', '') + text
+    color = np.where(change > 0, 'text-success', 'text-danger')
+    if html:
+        number = new + ' (<span class="' + color + '">' + text + '</span>)'
+        added = '<span class="text-success">' + new + '</span>'
+        removed = '<span class="text-danger">(-' + old + ')</span>'
+    else:
+        number = new + ' (' + text + ')'
+        added = new
+        removed = '(-' + old + ')'
+
+    diff = pd.Series(np.select(
+        [~changed, numeric, old == '', new == ''],
+        [new, number, added, removed],
+        added + ' ' + removed), index=new.index)
+    return (diff.unstack().reindex(index=index, columns=columns)
+                .rename_axis(None).rename_axis(None, axis=1))
+
+
+def diff_column(job):
+    """
+    Diff the value counts of one column
 
+    The csvs are parsed and the diff saved to csv here so that all of the
+    work on a column is done in its worker. Errors are caught so that one
+    column can't stop the others from being diffed.
+
+    :param job: The table, column, and value counts csv in each summary
+    :returns: The table, column, diff, its csv, and formatted error if any.
+        The diff is None if either summary has no values.
+    """
+    table, column, data_1, data_2 = job
+    try:
+        if column == 'summary':
+            df_1, df_2 = [pd.read_csv(io.BytesIO(data), index_col=0,
+                                      dtype=str, keep_default_na=False)
+                          for data in (data_1, data_2)]
+            diff = describe_diff(df_1, df_2)
+            if diff is None:
+                return table, column, None, None, None
+            plain = describe_diff(df_1, df_2, html=False)
+            return table, column, diff, plain.to_csv(), None
+        df_1 = pd.read_csv(io.BytesIO(data_1), index_col=0)
+        df_2 = pd.read_csv(io.BytesIO(data_2), index_col=0)
+        if len(df_1) == 0 or len(df_2) == 0:
+            return table, column, None, None, None
+        diff = count_diff(df_1, df_2)
+        return table, column, diff, diff.to_csv(), None
+    except Exception:
+        return table, column, None, None, traceback.format_exc()
+
+
+def changed_columns(manifest_1, manifest_2):
+    """
+    Find the (table, column) pairs in both manifests whose digests differ
+
+    Returns None if either summary has no manifest.
+    """
+    if manifest_1 is None or manifest_2 is None:
+        return None
+    return {(table, column)
+            for table, columns in manifest_1.items()
+            for column, digest in columns.items()
+            if manifest_2.get(table, {}).get(column, digest) != digest}
 
 
 # For local testing
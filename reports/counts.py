@@ -5,14 +5,111 @@ import matplotlib
 matplotlib.use('PS')
 import matplotlib.pyplot as plt
 import boto3
-from botocore.vendored import requests
+
+from reports import dataservice, credentials
+from reports.workspace import Workspace
+
+# Genomic files of each study, reached through the biospecimens they were
+# sequenced from
+STUDY_GENOMIC_FILES = """
+SELECT DISTINCT p.study_id, bg.genomic_file_id
+FROM participant p
+JOIN biospecimen b ON b.participant_id = p.kf_id
+JOIN biospecimen_genomic_file bg ON bg.biospecimen_id = b.kf_id
+"""
+
+# Count of each endpoint's entity per study, used by the sql backend
+ENTITY_QUERIES = {
+    '/investigators': """
+        SELECT s.kf_id, count(DISTINCT s.investigator_id)
+        FROM study s
+        GROUP BY s.kf_id""",
+    '/study-files': """
+        SELECT sf.study_id, count(*)
+        FROM study_file sf
+        GROUP BY sf.study_id""",
+    '/families': """
+        SELECT p.study_id, count(DISTINCT p.family_id)
+        FROM participant p
+        GROUP BY p.study_id""",
+    '/family-relationships': """
+        SELECT p.study_id, count(DISTINCT fr.kf_id)
+        FROM family_relationship fr
+        JOIN participant p ON p.kf_id IN (fr.participant1_id,
+                                          fr.participant2_id)
+        GROUP BY p.study_id""",
+    '/cavatica-apps': """
+        SELECT gf.study_id, count(DISTINCT ct.cavatica_app_id)
+        FROM study_gf gf
+        JOIN cavatica_task_genomic_file ctg
+          ON ctg.genomic_file_id = gf.genomic_file_id
+        JOIN cavatica_task ct ON ct.kf_id = ctg.cavatica_task_id
+        GROUP BY gf.study_id""",
+    '/sequencing-centers': """
+        SELECT p.study_id, count(DISTINCT b.sequencing_center_id)
+        FROM participant p
+        JOIN biospecimen b ON b.participant_id = p.kf_id
+        GROUP BY p.study_id""",
+    '/participants': """
+        SELECT p.study_id, count(*)
+        FROM participant p
+        GROUP BY p.study_id""",
+    '/diagnoses': """
+        SELECT p.study_id, count(*)
+        FROM diagnosis d
+        JOIN participant p ON p.kf_id = d.participant_id
+        GROUP BY p.study_id""",
+    '/phenotypes': """
+        SELECT p.study_id, count(*)
+        FROM phenotype ph
+        JOIN participant p ON p.kf_id = ph.participant_id
+        GROUP BY p.study_id""",
+    '/outcomes': """
+        SELECT p.study_id, count(*)
+        FROM outcome o
+        JOIN participant p ON p.kf_id = o.participant_id
+        GROUP BY p.study_id""",
+    '/biospecimens': """
+        SELECT p.study_id, count(*)
+        FROM biospecimen b
+        JOIN participant p ON p.kf_id = b.participant_id
+        GROUP BY p.study_id""",
+    '/genomic-files': """
+        SELECT gf.study_id, count(*)
+        FROM study_gf gf
+        GROUP BY gf.study_id""",
+    '/sequencing-experiments': """
+        SELECT gf.study_id, count(DISTINCT g.sequencing_experiment_id)
+        FROM study_gf gf
+        JOIN genomic_file g ON g.kf_id = gf.genomic_file_id
+        GROUP BY gf.study_id""",
+    '/cavatica-tasks': """
+        SELECT gf.study_id, count(DISTINCT ctg.cavatica_task_id)
+        FROM study_gf gf
+        JOIN cavatica_task_genomic_file ctg
+          ON ctg.genomic_file_id = gf.genomic_file_id
+        GROUP BY gf.study_id""",
+    '/cavatica-task-genomic-files': """
+        SELECT gf.study_id, count(DISTINCT ctg.kf_id)
+        FROM study_gf gf
+        JOIN cavatica_task_genomic_file ctg
+          ON ctg.genomic_file_id = gf.genomic_file_id
+        GROUP BY gf.study_id""",
+}
 
 
 def handler(event, context):
-    """ Get counts for each type of entity """
+    """
+    Get counts for each type of entity
+
+    Counts come from the dataservice api by default. Setting `"backend":
+    "sql"` on the report in config.json computes them directly from the
+    dataservice database instead.
+    """
     api = os.environ.get('DATASERVICE', None)
     output = event.get('output')
-    if api is None:
+    backend = event.get('backend', 'api')
+    if api is None and backend == 'api':
         return
 
     # List of entities
@@ -34,13 +131,15 @@ def handler(event, context):
         '/cavatica-task-genomic-files'
     ]
 
-    # Get study kf_ids
-    resp = requests.get(api+'/studies?limit=100')
-    studies = [s['kf_id'] for s in resp.json()['results']]
+    if backend == 'sql':
+        counts = by_study_sql(credentials.pg_connection_str(), endpoints)
+    else:
+        client = dataservice.Client.from_event(api, event)
+        counts = by_study(client, endpoints, client.studies())
 
-    counts = by_study(api, endpoints, studies)
-
-    with open('/tmp/counts.csv.gz', 'wb') as csv_file:
+    workspace = Workspace.from_event(event)
+    data_path = workspace.file('counts.csv.gz')
+    with open(data_path, 'wb') as csv_file:
         with gzip.open(csv_file, 'wt') as gz:
             writer = csv.writer(gz)
             writer.writerow(['study_id']+endpoints)
@@ -61,33 +160,65 @@ def handler(event, context):
     plt.title('Entity Counts by Endpoint and Study')
     plt.tight_layout()
 
-    plt.savefig('/tmp/entity_counts_by_study.png')
+    plot_path = workspace.file('entity_counts_by_study.png')
+    plt.savefig(plot_path)
 
     s3_url = 'https://s3.amazonaws.com/' + output
 
     files = {
-        'Entity Counts by Study Breakdown': '/tmp/entity_counts_by_study.png',
-        'Entity Counts by Study Data': '/tmp/counts.csv.gz'
+        'Entity Counts by Study Breakdown': plot_path,
+        'Entity Counts by Study Data': data_path
     }
 
     return [], files
 
 
-def by_study(api, endpoints, studies):
-    """ Get counts by endpoint """
-    counts_by_study = {}
+def by_study(client, endpoints, studies):
+    """
+    Get counts by endpoint
 
+    Every (study, endpoint) total is requested concurrently through the
+    dataservice client.
+    """
+    urls = [endpoint+'?limit=1&study_id='+study
+            for study in studies
+            for endpoint in endpoints]
+    print(f'get {len(urls)} totals with concurrency {client.concurrency}')
+    totals = iter([r['total'] for r in client.get_many(urls)])
+
+    counts_by_study = {}
     for study in studies:
-        by_endpoint = []
-        for endpoint in endpoints:
-            print('get', api+endpoint+'?limit=1&study_id='+study)
-            resp = requests.get(api+endpoint+'?limit=1&study_id='+study)
-            by_endpoint.append(resp.json()['total'])
-        counts_by_study[study] = by_endpoint
+        counts_by_study[study] = [next(totals) for _ in endpoints]
 
     return counts_by_study
 
 
+def by_study_sql(conn_str, endpoints):
+    """
+    Get counts by endpoint for every study with one grouped query
+    against the dataservice database
+    """
+    # Imported here so the api backend doesn't pay for importing pandas
+    import pandas as pd
+
+    selects = [f"SELECT '{endpoint}' AS endpoint, q.* FROM ({query}) AS q"
+               for endpoint, query in ENTITY_QUERIES.items()
+               if endpoint in endpoints]
+    stmt = (f"WITH study_gf AS ({STUDY_GENOMIC_FILES})\n" +
+            '\nUNION ALL\n'.join(selects))
+    df = pd.read_sql_query(stmt, con=conn_str)
+    df.columns = ['endpoint', 'study_id', 'count']
+
+    studies = pd.read_sql_query('SELECT kf_id FROM study ORDER BY created_at',
+                                con=conn_str)['kf_id']
+    df = (df.pivot(index='study_id', columns='endpoint', values='count')
+            .reindex(index=studies, columns=endpoints)
+            .fillna(0)
+            .astype(int))
+
+    return {study: row.tolist() for study, row in df.iterrows()}
+
+
 # For local testing
 if __name__ == '__main__':
     handler({ "name": "counts",
@@ -0,0 +1,182 @@
+import os
+import time
+import threading
+from base64 import b64decode
+
+import boto3
+
+# Seconds a vault secret is reused for when vault doesn't give it a lease
+SECRET_TTL = 15 * 60
+# Fraction of a secret's lease it's reused for, so it's read again before
+# the lease runs out. Secrets are never reused for more than SECRET_TTL.
+LEASE_MARGIN = 0.8
+# Number of idle database connections kept open between invocations
+POOL_SIZE = 4
+
+# Everything here is kept at the module level, so it lasts as long as the
+# lambda container does and is reused by every warm invocation
+_LOCK = threading.Lock()
+# Plaintexts of KMS secrets keyed by their ciphertext
+_DECRYPTED = {}
+# (expires, data) of vault secrets keyed by their path
+_SECRETS = {}
+# (credentials, connection) of idle database connections
+_CONNECTIONS = []
+# Credentials of the connections handed out by `connect`, keyed by id
+_ISSUED = {}
+
+
+def kms_decrypt(secret):
+    """
+    Decrypt a base64 encoded KMS secret, such as the slack token
+
+    The plaintext is cached, so KMS is only called once per container.
+    """
+    with _LOCK:
+        if secret not in _DECRYPTED:
+            kms = boto3.client('kms', region_name='us-east-1')
+            resp = kms.decrypt(CiphertextBlob=b64decode(secret))
+            _DECRYPTED[secret] = resp['Plaintext'].decode('utf-8')
+        return _DECRYPTED[secret]
+
+
+def vault_secret(path):
+    """
+    Read a secret from vault, logging in with the lambda's IAM role
+
+    The secret is reused until most of its lease has passed, or for
+    SECRET_TTL seconds if it has no lease or a longer one, so rotated
+    secrets are picked up.
+    """
+    with _LOCK:
+        expires, data = _SECRETS.get(path, (0, None))
+        if expires > time.time():
+            return data
+        # Imported here so reports that never read a secret don't pay for
+        # importing the vault client
+        import hvac
+
+        client = hvac.Client(url=os.environ.get('VAULT_URL'))
+        credentials = boto3.Session().get_credentials()
+        client.auth_aws_iam(credentials.access_key,
+                            credentials.secret_key,
+                            credentials.token)
+        resp = client.read(path)
+        lease = resp.get('lease_duration') or SECRET_TTL
+        ttl = min(lease * LEASE_MARGIN, SECRET_TTL)
+        _SECRETS[path] = (time.time() + ttl, resp['data'])
+        return resp['data']
+
+
+def pg_credentials():
+    """
+    Get the host, database, user and password of the dataservice database
+    """
+    secret = vault_secret(os.environ.get('DATASERVICE_PG_SECRET'))
+    return (secret['hostname'], 'kfpostgres'+os.environ.get('ENV'),
+            secret['username'], secret['password'])
+
+
+def pg_connection_str():
+    """
+    Get the connection string of the dataservice database, or the one in
+    the `CONN_STR` environment variable if set
+    """
+    if 'CONN_STR' in os.environ:
+        return os.environ['CONN_STR']
+    host, dbname, usr, pas = pg_credentials()
+    return f"postgres://{usr}:{pas}@{host}:5432/{dbname}"
+
+
+def connect():
+    """
+    Get a connection to the dataservice database, reusing an idle one left
+    by an earlier report if it's still healthy
+
+    If the database turns down the credentials, they may have been rotated
+    since they were read from vault, so they're read again and the
+    connection is tried once more.
+    Connections should be given back with `release` rather than closed.
+    """
+    import psycopg2
+
+    if 'CONN_STR' in os.environ:
+        return pooled_connection(os.environ['CONN_STR'])
+    try:
+        return pooled_connection(pg_credentials())
+    except psycopg2.OperationalError as err:
+        print(f'reading the database credentials again: {err}')
+        with _LOCK:
+            _SECRETS.pop(os.environ.get('DATASERVICE_PG_SECRET'), None)
+        return pooled_connection(pg_credentials())
+
+
+def pooled_connection(credentials):
+    """
+    Take a healthy idle connection made with `credentials` from the pool,
+    or open a new one
+
+    :param credentials: A connection string, or the host, database, user
+        and password from `pg_credentials`
+    """
+    import psycopg2
+
+    while True:
+        with _LOCK:
+            # Connections made before the credentials rotated are stale
+            for stale in [c for c in _CONNECTIONS if c[0] != credentials]:
+                _CONNECTIONS.remove(stale)
+                stale[1].close()
+            if not _CONNECTIONS:
+                break
+            conn = _CONNECTIONS.pop()[1]
+        if healthy(conn):
+            _ISSUED[id(conn)] = credentials
+            return conn
+        conn.close()
+
+    if isinstance(credentials, str):
+        conn = psycopg2.connect(credentials)
+    else:
+        host, dbname, user, password = credentials
+        conn = psycopg2.connect(host=host, dbname=dbname, user=user,
+                                password=password)
+    _ISSUED[id(conn)] = credentials
+    return conn
+
+
+def release(conn):
+    """
+    Give back a connection from `connect` to be reused by later reports
+
+    Any open transaction is rolled back and the session is reset.
+    Connections past POOL_SIZE are closed instead.
+    """
+    credentials = _ISSUED.pop(id(conn), None)
+    if conn.closed:
+        return
+    try:
+        conn.reset()
+    except Exception:
+        conn.close()
+        return
+    with _LOCK:
+        if credentials is not None and len(_CONNECTIONS) < POOL_SIZE:
+            _CONNECTIONS.append((credentials, conn))
+            return
+    conn.close()
+
+
+def healthy(conn):
+    """
+    Check that a connection is still open and the server answers on it
+    """
+    if conn.closed:
+        return False
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except Exception:
+        return False
@@ -0,0 +1,225 @@
+import os
+import json
+import time
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from botocore.vendored import requests
+
+# Defaults for talking to the dataservice
+CONCURRENCY = 8
+TIMEOUT = 30
+RETRIES = 3
+BACKOFF = 0.5
+PAGE_SIZE = 100
+# Seconds a cached response stays valid
+CACHE_TTL = 300
+# Max number of responses cached in memory
+CACHE_SIZE = 256
+
+# (expires, body) of responses cached by url, least recently used first,
+# kept for as long as the lambda container is warm
+_CACHE = OrderedDict()
+_CACHE_LOCK = threading.Lock()
+
+
+def get_session(pool_size=CONCURRENCY):
+    """
+    Create a session with a connection pool large enough to keep one
+    keep-alive connection open per worker
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                            pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get(session, url, timeout=TIMEOUT, retries=RETRIES, backoff=BACKOFF):
+    """
+    Get a url and return the json body
+
+    Connection errors, timeouts, and 5xx responses are retried up to
+    `retries` times, waiting `backoff * 2^attempt` seconds between attempts.
+    """
+    for attempt in range(retries + 1):
+        try:
+            resp = session.get(url, timeout=timeout)
+            if resp.status_code < 500 or attempt == retries:
+                resp.raise_for_status()
+                return resp.json()
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == retries:
+                raise
+        print(f'retrying {url}')
+        time.sleep(backoff * 2 ** attempt)
+
+
+def cache_get(url, now):
+    """
+    Get a response from the in-memory cache, or None if there's no fresh
+    copy of it
+    """
+    with _CACHE_LOCK:
+        if url not in _CACHE:
+            return None
+        expires, body = _CACHE[url]
+        if expires <= now:
+            del _CACHE[url]
+            return None
+        _CACHE.move_to_end(url)
+        return body
+
+
+def cache_put(url, expires, body):
+    """
+    Add a response to the in-memory cache, evicting expired responses and
+    then the least recently used until it fits in CACHE_SIZE
+    """
+    with _CACHE_LOCK:
+        _CACHE[url] = (expires, body)
+        _CACHE.move_to_end(url)
+        now = time.time()
+        for key in [k for k, (e, _) in _CACHE.items() if e <= now]:
+            del _CACHE[key]
+        while len(_CACHE) > CACHE_SIZE:
+            _CACHE.popitem(last=False)
+
+
+class Client:
+
+    def __init__(self, api, concurrency=CONCURRENCY, timeout=TIMEOUT,
+                 retries=RETRIES, ttl=CACHE_TTL, cache_dir=None):
+        """
+        :param api: The base url of the dataservice
+        :param concurrency: The max number of requests in flight at once
+        :param timeout: Seconds to wait on each request
+        :param retries: Times to retry a failed request
+        :param ttl: Seconds a cached response may be reused. Responses are
+            always cached in memory and, if `cache_dir` is given, on disk.
+        :param cache_dir: Directory to cache responses in, defaults to the
+            `DATASERVICE_CACHE_DIR` environment variable if set
+        """
+        self.api = api
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.ttl = ttl
+        self.cache_dir = cache_dir or os.environ.get('DATASERVICE_CACHE_DIR')
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+        # Pagination prefetches one page per worker on top of the workers
+        self.session = get_session(2*concurrency)
+
+    @classmethod
+    def from_event(cls, api, event):
+        """
+        Create a client configured by the report's entry in config.json
+        """
+        return cls(api,
+                   concurrency=event.get('concurrency', CONCURRENCY),
+                   timeout=event.get('timeout', TIMEOUT),
+                   retries=event.get('retries', RETRIES),
+                   ttl=event.get('cache_ttl', CACHE_TTL),
+                   cache_dir=event.get('cache_dir'))
+
+    def get(self, url):
+        """
+        Get the json body of a path on the dataservice, from the cache if a
+        fresh enough copy is there
+        """
+        url = self.api+url
+        now = time.time()
+        body = cache_get(url, now)
+        if body is not None:
+            return body
+
+        path = None
+        if self.cache_dir:
+            key = hashlib.sha1(url.encode()).hexdigest()
+            path = os.path.join(self.cache_dir, f'{key}.json')
+            cached = read_cached(path)
+            if cached is not None and cached[0] > now:
+                cache_put(url, *cached)
+                return cached[1]
+
+        body = get(self.session, url,
+                   timeout=self.timeout, retries=self.retries)
+        expires = now + self.ttl
+        cache_put(url, expires, body)
+        if path:
+            write_cached(path, expires, body)
+        return body
+
+    def get_many(self, urls):
+        """
+        Get a list of paths concurrently
+
+        Returns the json bodies in the same order as `urls`.
+        """
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            return list(pool.map(self.get, urls))
+
+    def paginate(self, url):
+        """
+        Lazily yield every result of a listing endpoint, page by page
+
+        The dataservice paginates with an `after` cursor, so the url of the
+        next page is only known once the previous page has arrived. The next
+        page is prefetched in the background while the results of the
+        current page are being consumed.
+        """
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            page = self.get(url)
+            while page:
+                next_url = page.get('_links', {}).get('next')
+                future = None
+                if next_url and page['results']:
+                    future = pool.submit(self.get, next_url)
+                yield from page['results']
+                page = future.result() if future else None
+
+    def studies(self):
+        """
+        Get the kf_ids of every study
+        """
+        return [s['kf_id']
+                for s in self.paginate(f'/studies?limit={PAGE_SIZE}')]
+
+
+def read_cached(path):
+    """
+    Read the (expires, body) of a response cached on disk, or None if it
+    isn't cached or the file is unreadable
+    """
+    try:
+        with open(path) as f:
+            expires, body = json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        print(f'ignoring corrupt cache file {path}')
+        return None
+    return expires, body
+
+
+def write_cached(path, expires, body):
+    """
+    Cache a response on disk
+
+    The response is written to a temporary file that replaces the cached
+    file once complete, so a failed write never leaves a partial file.
+    """
+    directory = os.path.dirname(path)
+    with tempfile.NamedTemporaryFile('w', dir=directory, suffix='.tmp',
+                                     delete=False) as f:
+        try:
+            json.dump([expires, body], f)
+        except Exception:
+            f.close()
+            os.remove(f.name)
+            raise
+    os.replace(f.name, path)
@@ -0,0 +1,20 @@
+from datetime import datetime, timedelta
+
+
+def output_date(output):
+    """
+    Get the date of a report from its `<date>-reports` output directory
+    """
+    prefix = output.replace('s3://', '').rstrip('/')
+    return datetime.strptime(prefix.split('/')[-2].replace('-reports', ''),
+                             '%Y%m%d')
+
+
+def previous_output(output, days=1):
+    """
+    Get the output path the same report had `days` before this one
+    """
+    date = output_date(output)
+    previous = date - timedelta(days=days)
+    return output.replace(date.strftime('%Y%m%d'),
+                          previous.strftime('%Y%m%d'))
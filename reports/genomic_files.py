@@ -1,18 +1,42 @@
 import csv
 import gzip
 import os
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
 import matplotlib
 matplotlib.use('PS')
 import matplotlib.pyplot as plt
 import boto3
-from botocore.vendored import requests
+
+from reports import dataservice, credentials
+from reports.workspace import Workspace
+
+# Count of genomic files per study and data type, used by the sql backend
+DATA_TYPE_QUERY = """
+SELECT p.study_id, gf.data_type, count(DISTINCT gf.kf_id) AS count
+FROM genomic_file gf
+JOIN biospecimen_genomic_file bg ON bg.genomic_file_id = gf.kf_id
+JOIN biospecimen b ON b.kf_id = bg.biospecimen_id
+JOIN participant p ON p.kf_id = b.participant_id
+GROUP BY p.study_id, gf.data_type
+"""
 
 
 def handler(event, context):
-    """ Get counts for each type of genomic file """
+    """
+    Get counts for each type of genomic file
+
+    Counts come from the dataservice api by default. Setting `"backend":
+    "sql"` on the report in config.json computes them directly from the
+    dataservice database instead. Setting `"faceted": true` on an api report
+    counts every data type found in each study's files, not just those in
+    `data_types`.
+    """
     api = os.environ.get('DATASERVICE', None)
     output = event.get('output')
-    if api is None:
+    backend = event.get('backend', 'api')
+    if api is None and backend == 'api':
         return
 
     endpoint = '/genomic-files'
@@ -27,13 +51,21 @@ def handler(event, context):
                   'gVCF Index',
                   'Other']
 
-    # Get study kf_ids
-    resp = requests.get(api+'/studies?limit=100')
-    studies = [s['kf_id'] for s in resp.json()['results']]
-
-    counts = by_study(api, endpoint, studies, data_types)
-
-    with open('/tmp/datatypes.csv.gz', 'wb') as csv_file:
+    if backend == 'sql':
+        counts = by_study_sql(credentials.pg_connection_str(), data_types)
+    else:
+        client = dataservice.Client.from_event(api, event)
+        studies = client.studies()
+
+        if event.get('faceted', False):
+            data_types, counts = by_study_faceted(client, endpoint, studies,
+                                                  data_types)
+        else:
+            counts = by_study(client, endpoint, studies, data_types)
+
+    workspace = Workspace.from_event(event)
+    data_path = workspace.file('datatypes.csv.gz')
+    with open(data_path, 'wb') as csv_file:
         with gzip.open(csv_file, 'wt') as gz:
             writer = csv.writer(gz)
             writer.writerow(['study_id']+data_types)
@@ -54,33 +86,80 @@ def handler(event, context):
     plt.title('Genomic File Data Type Distribution by Study')
     plt.tight_layout()
 
-    plt.savefig('/tmp/gf_data_types_by_study.png')
-    plt.savefig('/tmp/gf_data_types_by_study_slack.png', dpi=20)
+    plot_path = workspace.file('gf_data_types_by_study.png')
+    plt.savefig(plot_path)
+    plt.savefig(workspace.file('gf_data_types_by_study_slack.png'), dpi=20)
 
     attachments = []
 
     files = {
-        'Genomic File Data Types by Study Breakdown': '/tmp/gf_data_types_by_study.png',
-        'Genomic File Data Types by Study Data': '/tmp/datatypes.csv.gz'
+        'Genomic File Data Types by Study Breakdown': plot_path,
+        'Genomic File Data Types by Study Data': data_path
     }
 
     return attachments, files
 
 
-def by_study(api, endpoint, studies, data_types):
+def by_study(client, endpoint, studies, data_types):
     """ Get counts by data type """
-    counts_by_study = {}
+    urls = [endpoint+'?limit=1&study_id='+study+'&data_type='+quote(data_type)
+            for study in studies
+            for data_type in data_types]
+    totals = iter([r['total'] for r in client.get_many(urls)])
 
+    counts_by_study = {}
     for study in studies:
-        by_data_type = []
-        for data_type in data_types:
-            resp = requests.get(api+endpoint+'?limit=1&study_id='+study+'&data_type='+data_type)
-            by_data_type.append(resp.json()['total'])
-        counts_by_study[study] = by_data_type
+        counts_by_study[study] = [next(totals) for _ in data_types]
 
     return counts_by_study
 
 
+def by_study_faceted(client, endpoint, studies, data_types):
+    """
+    Get counts by data type by paging through all of each study's genomic
+    files and tallying their data types
+
+    Studies are paged concurrently. Returns the list of data types, those in
+    `data_types` first followed by any others that were found, and the counts
+    by study in that order.
+    """
+    def histogram(study):
+        url = f'{endpoint}?limit={dataservice.PAGE_SIZE}&study_id={study}'
+        return Counter(str(gf.get('data_type'))
+                       for gf in client.paginate(url))
+
+    with ThreadPoolExecutor(max_workers=client.concurrency) as pool:
+        histograms = dict(zip(studies, pool.map(histogram, studies)))
+
+    found = set().union(*histograms.values())
+    data_types = list(data_types) + sorted(found - set(data_types))
+
+    counts_by_study = {}
+    for study, counts in histograms.items():
+        counts_by_study[study] = [counts[d] for d in data_types]
+
+    return data_types, counts_by_study
+
+
+def by_study_sql(conn_str, data_types):
+    """
+    Get counts by data type for every study with one grouped query
+    against the dataservice database
+    """
+    # Imported here so the api backend doesn't pay for importing pandas
+    import pandas as pd
+
+    df = pd.read_sql_query(DATA_TYPE_QUERY, con=conn_str)
+    studies = pd.read_sql_query('SELECT kf_id FROM study ORDER BY created_at',
+                                con=conn_str)['kf_id']
+    df = (df.pivot(index='study_id', columns='data_type', values='count')
+            .reindex(index=studies, columns=data_types)
+            .fillna(0)
+            .astype(int))
+
+    return {study: row.tolist() for study, row in df.iterrows()}
+
+
 # For local testing
 if __name__ == '__main__':
     handler({ "name": "genomic files",
@@ -0,0 +1,178 @@
+import io
+import pandas as pd
+
+from reports import snapshot
+from reports.storage import get_storage, MemoryStorage
+
+# Values seen in each table and the dates they were first and last seen
+INDEX_FILE = 'first_seen.csv.gz'
+# Directory of each table's `summary` stats, partitioned by date
+DESCRIBE_DIR = 'describe'
+
+
+def history_path(output):
+    """
+    Get the path of the history kept in the bucket of a report's output
+    """
+    bucket = output.replace('s3://', '').split('/')[0]
+    return f's3://{bucket}/history'
+
+
+class History:
+    """
+    An append-only store of the value counts of every summary
+
+    The counts of each table are partitioned by the date of the summary, as
+    `<table>/<YYYYMMDD>.csv.gz` holding (column, value, count), so looking
+    up a table on a date reads only that one file. The table's `summary`
+    stats are kept alongside in `<table>/describe/<YYYYMMDD>.csv.gz` holding
+    (column, stat, value). Each table also keeps an index of when every
+    value was first and last seen.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: The path or storage of the history
+        """
+        self.storage = get_storage(path)
+
+    def append(self, date, counts, describe=None):
+        """
+        Add the value counts of a summary to the history
+
+        Appending a date again replaces its counts. The index of each table
+        is read and rewritten whole, as it's small next to the counts.
+
+        :param date: The date of the summary as `YYYYMMDD`
+        :param counts: A dataframe of (table, column, value, count), as in a
+            snapshot
+        :param describe: A dataframe of (table, column, stat, value) of the
+            `summary` of each table, as in a snapshot
+        """
+        if describe is not None:
+            for table, df in describe.groupby('table', sort=False):
+                self.storage.write(
+                    f'{table}/{DESCRIBE_DIR}/{date}.csv.gz',
+                    snapshot.compress(df[['column', 'stat', 'value']]
+                                      .to_csv(index=False).encode()))
+
+        counts = counts[counts['count'].astype('int64') > 0]
+        for table, df in counts.groupby('table', sort=False):
+            df = df[['column', 'value', 'count']]
+            self.storage.write(f'{table}/{date}.csv.gz',
+                               snapshot.compress(
+                                   df.to_csv(index=False).encode()))
+
+            seen = df[['column', 'value']].assign(first_seen=date,
+                                                  last_seen=date)
+            index = self.index(table)
+            if index is not None:
+                seen = pd.concat([index, seen], ignore_index=True)
+            seen = (seen.groupby(['column', 'value'], sort=True)
+                        .agg({'first_seen': 'min', 'last_seen': 'max'})
+                        .reset_index())
+            self.storage.write(f'{table}/{INDEX_FILE}',
+                               snapshot.compress(
+                                   seen.to_csv(index=False).encode()))
+
+    def tables(self):
+        """ List the tables in the history """
+        return sorted(name[:-1] for name in self.storage.list()
+                      if name.endswith('/'))
+
+    def dates(self, table):
+        """ List the dates the history has counts of a table for """
+        return sorted(name[:-len('.csv.gz')]
+                      for name in self.storage.list(table)
+                      if name.endswith('.csv.gz') and name != INDEX_FILE)
+
+    def counts(self, table, date, column=None):
+        """
+        Look up the value counts of a table on a date
+
+        :param column: Only look up the counts of this column
+        :returns: A dataframe of (column, value, count), or None if the
+            history has no counts of the table on the date
+        """
+        df = read_csv(self.storage.read(f'{table}/{date}.csv.gz'))
+        if df is None:
+            return None
+        df['count'] = df['count'].astype('int64')
+        if column is not None:
+            df = df[df['column'] == column].reset_index(drop=True)
+        return df
+
+    def between(self, table, start, end, column=None):
+        """
+        Look up the value counts of a table on every date from `start` to
+        `end`, inclusive
+
+        :returns: A dict of the counts on each date, in date order
+        """
+        return {date: self.counts(table, date, column)
+                for date in self.dates(table) if start <= date <= end}
+
+    def index(self, table):
+        """
+        Look up when every value of a table was first and last seen
+
+        :returns: A dataframe of (column, value, first_seen, last_seen), or
+            None if the table isn't in the history
+        """
+        return read_csv(self.storage.read(f'{table}/{INDEX_FILE}'))
+
+    def first_seen(self, table, column, value):
+        """
+        Look up the date a value first appeared in a column, or None if it
+        never has
+        """
+        index = self.index(table)
+        if index is None:
+            return None
+        seen = index[(index['column'] == column) & (index['value'] == value)]
+        return seen['first_seen'].iloc[0] if len(seen) else None
+
+    def summary(self, date, tables=None):
+        """
+        Read the summary of a date as summary csvs in memory, for the change
+        and trend reports
+
+        :param tables: Only read these tables, defaults to all of them
+        :returns: A storage holding the `<table>/<column>.csv` of every
+            column that had values on the date, and `<table>/summary.csv`
+            of every table with stats on the date. It's empty if the history
+            has nothing on the date.
+        """
+        tables = tables or self.tables()
+        paths = [f'{table}/{date}.csv.gz' for table in tables]
+        paths += [f'{table}/{DESCRIBE_DIR}/{date}.csv.gz' for table in tables]
+        partitions = self.storage.read_many(paths)
+        storage = MemoryStorage()
+        for table in tables:
+            df = read_csv(partitions[f'{table}/{date}.csv.gz'])
+            describe = read_csv(
+                partitions[f'{table}/{DESCRIBE_DIR}/{date}.csv.gz'])
+            if df is None and describe is None:
+                continue
+            if df is None:
+                df = pd.DataFrame(columns=['column', 'value', 'count'])
+            if describe is None:
+                describe = pd.DataFrame(columns=['column', 'stat', 'value'])
+            df['count'] = df['count'].astype('int64')
+            df.insert(0, 'table', table)
+            describe.insert(0, 'table', table)
+            for column, data in snapshot.to_csv_files(df, describe,
+                                                      table).items():
+                storage.write(f'{table}/{column}.csv', data)
+        return storage
+
+
+def read_csv(data):
+    """
+    Read a gzipped csv of the history with every value left as text, or
+    None if there is no data
+    """
+    if data is None:
+        return None
+    return pd.read_csv(io.BytesIO(data), compression='gzip', dtype=str,
+                       keep_default_na=False)
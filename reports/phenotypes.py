@@ -1,34 +1,15 @@
-import hvac
 import csv
-import gzip
-import os
 import matplotlib
 matplotlib.use('PS')
 import matplotlib.pyplot as plt
-import boto3
-import psycopg2
 from collections import defaultdict
 
+from reports import credentials
+from reports.workspace import Workspace
 
-def handler(event, context):
-    env = os.environ.get('ENV')
-    vault_url = os.environ.get('VAULT_URL')
-    path = os.environ.get('DATASERVICE_PG_SECRET')
-
-    client = hvac.Client(url=vault_url)
 
-    session = boto3.Session()
-    credentials = session.get_credentials()
-    r = client.auth_aws_iam(credentials.access_key,
-                            credentials.secret_key,
-                            credentials.token)
-    secret = client.read(path)['data']
-
-    conn = psycopg2.connect(
-            host=secret['hostname'],
-            dbname='kfpostgres'+env,
-            user=secret['username'],
-            password=secret['password'])
+def handler(event, context):
+    conn = credentials.connect()
 
     cur = conn.cursor()
 
@@ -41,13 +22,14 @@ def handler(event, context):
     """)
     data = cur.fetchall()
     cur.close()
-    conn.close()
+    credentials.release(conn)
 
     files = {}
     by_pheno = defaultdict(int)
     by_study = defaultdict(lambda: defaultdict(int))
 
-    path = '/tmp/phenotypes.csv'
+    workspace = Workspace.from_event(event)
+    path = workspace.file('phenotypes.csv')
     with open(path, 'w') as f:
         writer = csv.writer(f)
         writer.writerow(['source text phenotype', 'count', 'study_id'])
@@ -57,14 +39,14 @@ def handler(event, context):
             writer.writerow(v)
     files['Phenotype Data'] = path
 
-    files['All Studies'] = make_plot(by_pheno, 'all studies')
+    files['All Studies'] = make_plot(workspace, by_pheno, 'all studies')
     for study_id, d in by_study.items():
-        files[study_id] = make_plot(d, study_id)
+        files[study_id] = make_plot(workspace, d, study_id)
 
     return [], files
 
 
-def make_plot(d, title):
+def make_plot(workspace, d, title):
     plt.figure(figsize=(15, 10))
     ind = list(range(len(d)))
     plt.bar(ind, sorted(list(d.values()), reverse=True), width=0.5)
@@ -76,7 +58,7 @@ def make_plot(d, title):
     #plt.legend(bbox_to_anchor=(1.0, 1.0), ncol=2, loc=7)
     plt.title('Phenotype distribution for ' + title)
     plt.tight_layout()
-    path = '/tmp/phenotypes_{}.png'.format(title)
+    path = workspace.file('phenotypes_{}.png'.format(title))
     plt.savefig(path)
     return path
 
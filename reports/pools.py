@@ -0,0 +1,15 @@
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+
+def process_pool(workers):
+    """
+    Create a process pool, or a thread pool where processes aren't supported
+
+    Lambda has no /dev/shm, so multiprocessing can't create the semaphores
+    a process pool needs.
+    """
+    try:
+        return ProcessPoolExecutor(max_workers=workers)
+    except (OSError, NotImplementedError) as err:
+        print(f'falling back to threads, processes unavailable: {err}')
+        return ThreadPoolExecutor(max_workers=workers)
@@ -0,0 +1,173 @@
+import io
+import gzip
+import json
+import hashlib
+import pandas as pd
+
+# Files that hold a whole summary in the summaries directory
+COUNTS_FILE = 'snapshot.csv.gz'
+DESCRIBE_FILE = 'describe.csv.gz'
+# Digests of every summary csv in the summaries directory
+MANIFEST_FILE = 'manifest.json'
+
+
+def to_snapshot(files):
+    """
+    Pack the csv summaries of every table into two long tables
+
+    Values are kept as the text they have in the csvs so that a snapshot
+    unpacks to exactly the same files.
+
+    :param files: The contents of each summary csv keyed by table and then
+        column
+    :returns: A dataframe of (table, column, value, count) for the value
+        counts of every column, and one of (table, column, stat, value) for
+        the `summary` of every table
+    """
+    counts = []
+    describe = []
+    for table, columns in files.items():
+        for column, data in columns.items():
+            df = read_text_csv(data)
+            if column == 'summary':
+                df = (df.rename_axis('stat')
+                        .reset_index()
+                        .melt(id_vars='stat', var_name='column'))
+                df.insert(0, 'table', table)
+                describe.append(df[['table', 'column', 'stat', 'value']])
+            else:
+                df = df.rename(columns={df.columns[0]: 'value'})
+                # Keep columns without any values with a zero count
+                if len(df) == 0:
+                    df = pd.DataFrame({'value': [''], 'count': ['0']})
+                df.insert(0, 'column', column)
+                df.insert(0, 'table', table)
+                counts.append(df[['table', 'column', 'value', 'count']])
+
+    counts = (pd.concat(counts, ignore_index=True) if counts else
+              pd.DataFrame(columns=['table', 'column', 'value', 'count']))
+    describe = (pd.concat(describe, ignore_index=True) if describe else
+                pd.DataFrame(columns=['table', 'column', 'stat', 'value']))
+    return counts, describe
+
+
+def snapshot_files(files):
+    """
+    Pack the csv summaries of every table into the files of a snapshot
+
+    :returns: The contents of each snapshot file keyed by file name
+    """
+    counts, describe = to_snapshot(files)
+    return {
+        COUNTS_FILE: compress(counts.to_csv(index=False).encode()),
+        DESCRIBE_FILE: compress(describe.to_csv(index=False).encode()),
+    }
+
+
+def manifest(files):
+    """
+    Digest the csv summaries of every table
+
+    Summaries whose csvs have the same digest are identical, whether they
+    were saved as csvs or in a snapshot.
+
+    :returns: The json of the sha1 of each summary csv keyed by table and
+        then column
+    """
+    digests = {table: {column: hashlib.sha1(data).hexdigest()
+                       for column, data in columns.items()}
+               for table, columns in files.items()}
+    return json.dumps(digests, indent=2, sort_keys=True)
+
+
+def read_snapshot(counts_data, describe_data):
+    """
+    Load a snapshot from the contents of its files
+
+    :returns: The value counts and summaries dataframes of the snapshot
+    """
+    describe = pd.read_csv(io.BytesIO(describe_data), compression='gzip',
+                           dtype=str, keep_default_na=False)
+    return read_counts(counts_data), describe
+
+
+def read_counts(counts_data):
+    """
+    Load the value counts of a snapshot from the contents of its counts file
+    """
+    counts = pd.read_csv(io.BytesIO(counts_data), compression='gzip',
+                         dtype=str, keep_default_na=False)
+    counts['count'] = counts['count'].astype('int64')
+    return counts
+
+
+def list_columns(counts, describe):
+    """
+    List the columns summarized for each table in a snapshot, including
+    `summary` for tables that have one
+    """
+    columns = {}
+    for table, column in counts[['table', 'column']].drop_duplicates().values:
+        columns.setdefault(table, []).append(column)
+    for table in describe['table'].unique():
+        columns.setdefault(table, []).append('summary')
+    return columns
+
+
+def column_counts(counts, table, column):
+    """
+    Get the value counts of a column from a snapshot, formatted as they are
+    in its summary csv
+    """
+    df = counts[(counts['table'] == table) & (counts['column'] == column) &
+                (counts['count'] > 0)]
+    return (df[['value', 'count']].rename(columns={'value': column})
+                                  .reset_index(drop=True))
+
+
+def table_describe(describe, table):
+    """
+    Get the summary of a table from a snapshot, formatted as it is in its
+    summary csv
+    """
+    df = describe[describe['table'] == table]
+    # Restore the order of the stats and columns in the original summary
+    return (df.pivot(index='stat', columns='column', values='value')
+              .reindex(index=df['stat'].unique(),
+                       columns=df['column'].unique())
+              .rename_axis(None)
+              .rename_axis(None, axis=1))
+
+
+def to_csv_files(counts, describe, table):
+    """
+    Unpack the summary csvs of a table from a snapshot
+
+    :returns: The contents of each summary csv keyed by column
+    """
+    files = {}
+    for column in counts[counts['table'] == table]['column'].unique():
+        files[column] = (column_counts(counts, table, column)
+                         .to_csv().encode())
+    if (describe['table'] == table).any():
+        files['summary'] = table_describe(describe, table).to_csv().encode()
+    return files
+
+
+def read_text_csv(data):
+    """
+    Read summary csv contents with every value left as text
+    """
+    return pd.read_csv(io.BytesIO(data), index_col=0, dtype=str,
+                       keep_default_na=False)
+
+
+def compress(data):
+    """
+    Gzip data without a timestamp so the same data always compresses to the
+    same bytes
+    """
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
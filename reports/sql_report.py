@@ -1,50 +1,275 @@
-import os
+import io
+import re
 import csv
-import hvac
-import boto3
-import psycopg2
-import psycopg2.extras
+import gzip
+import json
+import time
+import queue
+import shutil
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+from reports.storage import get_storage
+from reports import credentials
+
+# Rows fetched from the server at a time when exporting with a cursor
+FETCH_SIZE = 10000
+# Max number of queries run at once, each on its own connection
+WORKERS = 4
+
+QUOTED_RE = re.compile(r"('(?:[^']|'')*')")
+
 
 def handler(event, context):
-    env = os.environ.get('ENV')
-    vault_url = os.environ.get('VAULT_URL')
-    path = os.environ.get('DATASERVICE_PG_SECRET')
-
-    if 'query_statement' not in event:
-        raise Exception('must include a query_statement for sql reports!')
-
-    query = event['query_statement']
-
-    client = hvac.Client(url=vault_url)
-
-    session = boto3.Session()
-    credentials = session.get_credentials()
-    r = client.auth_aws_iam(credentials.access_key,
-                            credentials.secret_key,
-                            credentials.token)
-    secret = client.read(path)['data']
-
-    conn = psycopg2.connect(
-            host=secret['hostname'],
-            dbname='kfpostgres'+env,
-            user=secret['username'],
-            password=secret['password'])
-
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    cur.execute(query)
-
-    fpath = '/tmp/report.csv'
-    with open(fpath, 'w') as f:
-        data = cur.fetchone()
-        writer = csv.DictWriter(f, fieldnames=data.keys())
-        writer.writeheader()
-        writer.writerow(data)
-        for line in cur:
-            writer.writerow(line)
-
-    cur.close()
-    conn.close()
-    return [], {'Report': fpath}
+    """
+    Export the results of one or more queries to csv
+
+    The event should have either a single `query_statement`, exported to
+    `report.csv`, or `queries` of sql keyed by name, each exported to
+    `<name>.csv`. Queries run at once over up to `workers` connections, all
+    reading the same snapshot of the database so their results agree.
+
+    The results are streamed from postgres straight to the report's output,
+    so memory use doesn't grow with the size of the results. The event may
+    also set:
+    `export`: `cursor` to fetch the results `fetch_size` rows at a time
+        through a server-side cursor, or `copy` to stream them with COPY
+    `gzip`: Whether to gzip the csv
+    `cache_ttl`: Seconds to reuse the results of the same query for, from
+        the cache in the report's bucket. Results aren't cached if unset.
+    """
+    if 'queries' in event:
+        queries = dict(event['queries'])
+    elif 'query_statement' in event:
+        queries = {'report': event['query_statement']}
+    else:
+        raise Exception('must include a query_statement or queries for sql '
+                        'reports!')
+
+    method = event.get('export', 'cursor')
+    if method not in ('cursor', 'copy'):
+        raise ValueError(f'unknown export method {method}')
+    compress = event.get('gzip', False)
+    ext = '.csv.gz' if compress else '.csv'
+
+    storage = get_storage('s3://'+event['output'])
+    files = {}
+    cache = None
+    if event.get('cache_ttl'):
+        bucket = event['output'].split('/')[0]
+        cache = ResultCache(f's3://{bucket}/sql_cache', event['cache_ttl'])
+        for name, query in list(queries.items()):
+            key = cache.key(query, method, compress)
+            if cache.copy(key, storage, name+ext):
+                print(f'reusing cached results of {name}')
+                files[name] = storage.url(name+ext)
+                del queries[name]
+    if queries:
+        files.update(export_queries(event, queries, storage, ext, method,
+                                    compress, cache))
+    if 'queries' not in event:
+        return [], {'Report': files['report']}
+    return [], files
+
+
+def export_queries(event, queries, storage, ext, method, compress, cache):
+    """
+    Export queries that weren't in the cache, and add them to it
+
+    :returns: The url each query was exported to keyed by name
+    """
+    files = {}
+    conns = snapshot_connections(credentials.connect, credentials.release,
+                                 min(event.get('workers', WORKERS),
+                                     len(queries)))
+    try:
+        paths = run_queries(conns, queries, storage, ext, method=method,
+                            compress=compress,
+                            fetch_size=event.get('fetch_size', FETCH_SIZE))
+    finally:
+        for conn in conns:
+            credentials.release(conn)
+
+    for name, path in paths.items():
+        files[name] = storage.url(path)
+        if cache is not None:
+            cache.add(cache.key(queries[name], method, compress), storage,
+                      path)
+    return files
+
+
+def snapshot_connections(connect, release, n):
+    """
+    Open `n` connections that all read the same snapshot of the database
+
+    The first connection exports the snapshot of its REPEATABLE READ
+    transaction and the others import it, so queries on any of them see
+    the same data. The first connection's transaction has to stay open for
+    the others to import it.
+    If any connection can't be opened or set up, those already opened are
+    given back with `release` before the error is raised.
+    """
+    conns = []
+    try:
+        for _ in range(n):
+            conns.append(connect())
+        for conn in conns:
+            conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+        with conns[0].cursor() as cur:
+            cur.execute('SELECT pg_export_snapshot()')
+            snapshot = cur.fetchone()[0]
+        for conn in conns[1:]:
+            with conn.cursor() as cur:
+                cur.execute('SET TRANSACTION SNAPSHOT %s', (snapshot,))
+    except Exception:
+        for conn in conns:
+            release(conn)
+        raise
+    return conns
+
+
+def run_queries(conns, queries, storage, ext='.csv', **kwargs):
+    """
+    Export many queries at once, one per connection at a time
+
+    :param queries: The sql of each query keyed by name
+    :param kwargs: Passed to `export`
+    :returns: The path each query was exported to keyed by name
+    """
+    pool = queue.Queue()
+    for conn in conns:
+        pool.put(conn)
+
+    def run(name):
+        conn = pool.get()
+        try:
+            export(conn, queries[name], storage, name+ext, **kwargs)
+        finally:
+            pool.put(conn)
+        return name, name+ext
+
+    with ThreadPoolExecutor(max_workers=len(conns)) as executor:
+        return dict(executor.map(run, queries))
+
+
+def export(conn, query, storage, path, method='cursor', compress=False,
+           fetch_size=FETCH_SIZE):
+    """
+    Stream the results of a query to a csv in a storage
+
+    :param conn: A psycopg2 connection
+    :param method: `cursor` or `copy`, see `handler`
+    :param compress: Whether to gzip the csv
+    :param fetch_size: Rows to fetch at a time with the `cursor` method
+    """
+    with storage.open_write(path) as f:
+        if compress:
+            f = gzip.GzipFile(fileobj=f, mode='wb', mtime=0)
+        try:
+            if method == 'copy':
+                copy_export(conn, query, f)
+            else:
+                cursor_export(conn, query, f, fetch_size)
+        finally:
+            if compress:
+                f.close()
+
+
+def copy_export(conn, query, f):
+    """
+    Stream the results of a query as csv with COPY, letting postgres format
+    the csv
+    """
+    query = query.strip().rstrip(';')
+    with conn.cursor() as cur:
+        cur.copy_expert(f'COPY ({query}) TO STDOUT WITH CSV HEADER', f)
+
+
+def cursor_export(conn, query, f, fetch_size=FETCH_SIZE):
+    """
+    Stream the results of a query as csv from a server-side cursor,
+    holding at most `fetch_size` rows in memory
+    """
+    text = io.TextIOWrapper(f, encoding='utf-8', newline='',
+                            write_through=True)
+    writer = csv.writer(text)
+    with conn.cursor(name='sql_report') as cur:
+        cur.itersize = fetch_size
+        cur.execute(query)
+        # Named cursors only describe the results once rows are fetched,
+        # even if there are none
+        rows = cur.fetchmany(fetch_size)
+        writer.writerow([column.name for column in cur.description])
+        while rows:
+            writer.writerows(rows)
+            rows = cur.fetchmany(fetch_size)
+    text.flush()
+    text.detach()
+
+
+def normalize(query):
+    """
+    Normalize the formatting of a query, collapsing whitespace outside of
+    string literals and dropping any trailing semicolon
+    """
+    parts = QUOTED_RE.split(query.strip().rstrip(';'))
+    return ''.join(part if i % 2 else re.sub(r'\s+', ' ', part)
+                   for i, part in enumerate(parts)).strip()
+
+
+class ResultCache:
+    """
+    Remembers where the results of each query were exported to, so that
+    running the same query again within `ttl` seconds copies those results
+    rather than querying the database
+
+    Each entry is a json file of when it expires and the storage and path
+    of the results, keyed by a hash of the normalized query.
+    """
+
+    def __init__(self, path, ttl):
+        """
+        :param path: The path or storage to keep the cache in
+        :param ttl: Seconds results may be reused for
+        """
+        self.storage = get_storage(path)
+        self.ttl = ttl
+
+    def key(self, query, method, compress):
+        """
+        Hash a query together with how its results are exported, which
+        changes the bytes of the csv
+        """
+        key = f'{method}:{compress}:{normalize(query)}'
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def copy(self, key, storage, path):
+        """
+        Copy the cached results of a query to a path in a storage
+
+        :returns: Whether fresh results were in the cache
+        """
+        entry = self.storage.read(f'{key}.json')
+        if entry is None:
+            return False
+        expires, url, cached = json.loads(entry)
+        if expires <= time.time():
+            return False
+        try:
+            src = get_storage(url).open(cached)
+        except FileNotFoundError:
+            return False
+        try:
+            with storage.open_write(path) as f:
+                shutil.copyfileobj(src, f)
+        finally:
+            src.close()
+        return True
+
+    def add(self, key, storage, path):
+        """ Remember the results of a query exported to a storage """
+        entry = [time.time() + self.ttl, storage.url(), path]
+        self.storage.write(f'{key}.json', json.dumps(entry))
 
 
 # For local testing
@@ -0,0 +1,394 @@
+import io
+import os
+import gzip
+import mimetypes
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.config import Config
+
+# Number of files read at once by `Storage.read_many`
+WORKERS = 16
+# Bytes buffered for each part of a streamed s3 upload, at least the 5MB
+# minimum s3 allows
+PART_SIZE = 8 * 1024 * 1024
+
+# Content types stored in s3 gzipped, with a gzip Content-Encoding that
+# browsers decompress as they download them
+ENCODED_TYPES = {'text/csv', 'text/html', 'application/json'}
+
+# Files of in-memory storages, keyed by the storage's name and then path
+_MEMORY = {}
+
+
+def get_storage(path):
+    """
+    Get the storage for a local path, an s3 path (`s3://bucket/prefix`), or
+    an in-memory path (`memory://name`)
+
+    Storages that share an in-memory name share their files. A storage
+    passed in place of a path is returned as it is.
+    """
+    if isinstance(path, Storage):
+        return path
+    path = str(path)
+    if path.startswith('s3://'):
+        bucket, _, prefix = path[len('s3://'):].partition('/')
+        return S3Storage(bucket, prefix)
+    if path.startswith('memory://'):
+        return MemoryStorage(path[len('memory://'):].strip('/'))
+    return LocalStorage(path)
+
+
+def content_type(path):
+    """
+    Guess the content type to store a file with from its name
+    """
+    content, encoding = mimetypes.guess_type(path)
+    if encoding == 'gzip':
+        return 'application/gzip'
+    return content or 'text/plain'
+
+
+def content_encoding(path):
+    """
+    Get the Content-Encoding to store a file with in s3, or None if it's
+    stored as it is
+    """
+    return 'gzip' if content_type(path) in ENCODED_TYPES else None
+
+
+def encode(data):
+    """ Gzip the contents of a file to store with a gzip Content-Encoding """
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+class Storage:
+    """
+    A directory that reports are read from and written to
+
+    Paths are relative to the root of the storage and separated by `/`.
+    """
+    # Whether reading a file means a round trip over the network
+    remote = False
+
+    def __init__(self):
+        # Paths of the files written, in the order they were written
+        self.written = []
+
+    def url(self, path=''):
+        """ Get the full path of a file in the storage """
+        raise NotImplementedError
+
+    def exists(self):
+        """ Whether the root of the storage exists """
+        return True
+
+    def list(self, path='', recursive=False):
+        """
+        List the names of the files and directories directly inside a
+        directory, with a trailing `/` on directories
+
+        If `recursive`, every file below the directory is listed by its
+        path relative to it instead. Missing directories are empty.
+        """
+        raise NotImplementedError
+
+    def open(self, path):
+        """
+        Open a file to be read as a binary stream
+
+        Raises FileNotFoundError if the file doesn't exist.
+        """
+        raise NotImplementedError
+
+    def read(self, path):
+        """
+        Read the contents of a file, or None if it doesn't exist
+        """
+        try:
+            f = self.open(path)
+        except FileNotFoundError:
+            return None
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def read_many(self, paths, workers=WORKERS):
+        """
+        Read many files at once
+
+        Returns the contents of each file keyed by path.
+        """
+        paths = list(paths)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return dict(zip(paths, pool.map(self.read, paths)))
+
+    def write(self, path, data):
+        """ Write the contents of a file, replacing it if it exists """
+        if isinstance(data, str):
+            data = data.encode()
+        self._write(path, data)
+        self.written.append(path)
+
+    def open_write(self, path):
+        """
+        Open a file to be written as a binary stream, for files too large to
+        hold in memory
+
+        The file is saved when the stream is closed. Streams to s3 or memory
+        are discarded if an exception leaves their `with` block.
+        """
+        self.written.append(path)
+        return self._open_write(path)
+
+    def _write(self, path, data):
+        raise NotImplementedError
+
+    def _open_write(self, path):
+        raise NotImplementedError
+
+
+class LocalStorage(Storage):
+    """
+    A directory on the local filesystem
+    """
+
+    def __init__(self, root):
+        super().__init__()
+        self.root = root
+
+    def url(self, path=''):
+        return os.path.join(self.root, path)
+
+    def exists(self):
+        return os.path.isdir(self.root)
+
+    def list(self, path='', recursive=False):
+        directory = self.url(path)
+        if not os.path.isdir(directory):
+            return []
+        if not recursive:
+            return [name + '/' if os.path.isdir(os.path.join(directory, name))
+                    else name for name in os.listdir(directory)]
+        return [os.path.relpath(os.path.join(d, name), directory)
+                     .replace(os.sep, '/')
+                for d, _, names in os.walk(directory) for name in names]
+
+    def open(self, path):
+        return open(self.url(path), 'rb')
+
+    def _write(self, path, data):
+        with self._open_write(path) as f:
+            f.write(data)
+
+    def _open_write(self, path):
+        path = self.url(path)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        return open(path, 'wb')
+
+
+class S3Storage(Storage):
+    """
+    A prefix in an s3 bucket
+
+    Files are streamed from the bodies of `get_object` and written with
+    managed uploads, which switch to multipart uploads for large files, or
+    streamed to s3 a part at a time with `open_write`. Text files written
+    whole are gzipped with a Content-Encoding, and decompressed again when
+    they're read.
+    """
+    remote = True
+
+    def __init__(self, bucket, prefix='', client=None):
+        """
+        :param client: The s3 client to use. Clients are thread safe, so one
+            can be shared between storages.
+        """
+        super().__init__()
+        self.bucket = bucket
+        self.prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+        self.client = client or boto3.client('s3', config=Config(
+            max_pool_connections=WORKERS))
+
+    def key(self, path):
+        return self.prefix + path.lstrip('/')
+
+    def url(self, path=''):
+        return f's3://{self.bucket}/{self.key(path)}'
+
+    def exists(self):
+        # s3 has no directories, so the prefix exists if any key is under it
+        resp = self.client.list_objects_v2(Bucket=self.bucket,
+                                           Prefix=self.prefix, MaxKeys=1)
+        return resp.get('KeyCount', 0) > 0
+
+    def list(self, path='', recursive=False):
+        prefix = self.key(path).rstrip('/') + '/' if path else self.prefix
+        kwargs = {} if recursive else {'Delimiter': '/'}
+        paginator = self.client.get_paginator('list_objects_v2')
+        names = []
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix,
+                                       **kwargs):
+            names.extend(p['Prefix'][len(prefix):]
+                         for p in page.get('CommonPrefixes', []))
+            names.extend(obj['Key'][len(prefix):]
+                         for obj in page.get('Contents', []))
+        return names
+
+    def open(self, path):
+        try:
+            resp = self.client.get_object(Bucket=self.bucket,
+                                          Key=self.key(path))
+        except self.client.exceptions.NoSuchKey:
+            raise FileNotFoundError(self.url(path))
+        if 'gzip' in resp.get('ContentEncoding', '').split(','):
+            return gzip.GzipFile(fileobj=resp['Body'], mode='rb')
+        return resp['Body']
+
+    def _write(self, path, data):
+        args = {'ContentType': content_type(path)}
+        if content_encoding(path):
+            data = encode(data)
+            args['ContentEncoding'] = content_encoding(path)
+        self.client.upload_fileobj(io.BytesIO(data), self.bucket,
+                                   self.key(path), ExtraArgs=args)
+
+    def _open_write(self, path):
+        return S3Writer(self.client, self.bucket, self.key(path),
+                        content_type(path))
+
+
+class MemoryStorage(Storage):
+    """
+    Files kept in memory, mostly for tests
+    """
+
+    def __init__(self, name=None):
+        """
+        :param name: Storages with the same name share their files. Unnamed
+            storages have files of their own.
+        """
+        super().__init__()
+        self.name = name
+        self.files = _MEMORY.setdefault(name, {}) if name else {}
+
+    def url(self, path=''):
+        return f'memory://{self.name or ""}/{path}'
+
+    def list(self, path='', recursive=False):
+        prefix = path.rstrip('/') + '/' if path else ''
+        names = [p[len(prefix):] for p in self.files if p.startswith(prefix)]
+        if recursive:
+            return names
+        return sorted({n.split('/')[0] + '/' if '/' in n else n
+                       for n in names})
+
+    def open(self, path):
+        if path not in self.files:
+            raise FileNotFoundError(self.url(path))
+        return io.BytesIO(self.files[path])
+
+    def _write(self, path, data):
+        self.files[path] = data
+
+    def _open_write(self, path):
+        return MemoryWriter(self.files, path)
+
+
+class S3Writer(io.RawIOBase):
+    """
+    A binary stream uploaded to s3 in parts as it's written, so that only
+    one part is ever held in memory
+
+    Streams smaller than a part are uploaded with a single put.
+    """
+
+    def __init__(self, client, bucket, key, content, part_size=PART_SIZE):
+        super().__init__()
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.content = content
+        self.part_size = part_size
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer.extend(data)
+        if len(self.buffer) >= self.part_size:
+            self._upload_part()
+        return len(data)
+
+    def _upload_part(self):
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key,
+                ContentType=self.content)['UploadId']
+        number = len(self.parts) + 1
+        resp = self.client.upload_part(Bucket=self.bucket, Key=self.key,
+                                       UploadId=self.upload_id,
+                                       PartNumber=number,
+                                       Body=bytes(self.buffer))
+        self.parts.append({'ETag': resp['ETag'], 'PartNumber': number})
+        self.buffer = bytearray()
+
+    def close(self):
+        if self.closed:
+            return
+        if self.upload_id is None:
+            self.client.put_object(Bucket=self.bucket, Key=self.key,
+                                   Body=bytes(self.buffer),
+                                   ContentType=self.content)
+        else:
+            if self.buffer:
+                self._upload_part()
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                MultipartUpload={'Parts': self.parts})
+        super().close()
+
+    def abort(self):
+        """ Discard everything written """
+        if self.upload_id is not None:
+            self.client.abort_multipart_upload(Bucket=self.bucket,
+                                               Key=self.key,
+                                               UploadId=self.upload_id)
+        self.buffer = bytearray()
+        super().close()
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
+class MemoryWriter(io.BytesIO):
+    """
+    A binary stream saved to the files of an in-memory storage when closed
+    """
+
+    def __init__(self, files, path):
+        super().__init__()
+        self.files = files
+        self.path = path
+
+    def close(self):
+        if not self.closed:
+            self.files[self.path] = self.getvalue()
+        super().close()
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            super().close()
@@ -1,35 +1,16 @@
-import hvac
 import os
-import glob
 import pandas as pd
 import matplotlib
 matplotlib.use('PS')
 import matplotlib.pyplot as plt
-import boto3
 from botocore.vendored import requests
 
 import matplotlib.pyplot as plt
 from xhtml2pdf import pisa
 from jinja2 import Environment, FileSystemLoader
 
-
-def get_pg_connection_str():
-    env = os.environ.get('ENV')
-    vault_url = os.environ.get('VAULT_URL')
-    path = os.environ.get('DATASERVICE_PG_SECRET')
-
-    session = boto3.Session()
-    client = hvac.Client(url=vault_url)
-    credentials = session.get_credentials()
-    r = client.auth_aws_iam(credentials.access_key,
-                            credentials.secret_key,
-                            credentials.token)
-    secret = client.read(path)['data']
-
-    usr = secret['username']
-    pas = secret['password']
-    host = secret['hostname']
-    return f"postgres://{usr}:{pas}@{host}:5432/kfpostgres{env}"
+from reports import credentials
+from reports.workspace import Workspace
 
 
 def handler(event, context):
@@ -38,14 +19,14 @@ def handler(event, context):
     """
     study_id = event.get('study_id')
     output = event.get('output')
-    conn_str = get_pg_connection_str()
-    g = ReportGenerator(study_id, output=f"/tmp/", conn_str=conn_str)
+    conn_str = credentials.pg_connection_str()
+    workspace = Workspace.from_event(event)
+    g = ReportGenerator(study_id, output=workspace.path+'/',
+                        conn_str=conn_str)
     g.make_report()
 
-    files = set(glob.glob('/tmp/**/*.png', recursive=True))
-    files = files.union(set(glob.glob('/tmp/**/*.csv', recursive=True)))
-    files = files.union(set(glob.glob('/tmp/**/*.pdf', recursive=True)))
-    return [], {p.replace('/tmp/', ''): p for p in list(files)}
+    files = workspace.files('.png', '.csv', '.pdf')
+    return [], {workspace.name(p): p for p in files}
 
 
 class ReportGenerator:
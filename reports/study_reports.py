@@ -1,7 +1,8 @@
 import os
 import json
 import boto3
-from botocore.vendored import requests
+
+from reports import dataservice
 
 
 def handler(event, context):
@@ -10,8 +11,7 @@ def handler(event, context):
     """
     # Call dataservice to get study list
     api = os.environ.get('DATASERVICE', None)
-    resp = requests.get(api+'/studies?limit=100')
-    studies = [s['kf_id'] for s in resp.json()['results']]
+    studies = dataservice.Client.from_event(api, event).studies()
 
     # Get s3 location where this report is to be saved
     output = event.get( 'output')
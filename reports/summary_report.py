@@ -1,16 +1,24 @@
 from datetime import datetime, timedelta
-import hvac
 import re
 import os
-import glob
+import io
 import json
+import hashlib
+import numpy as np
 import pandas as pd
 import boto3
 from botocore.vendored import requests
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 from jinja2 import Environment, FileSystemLoader
 
+from reports import snapshot, credentials
+from reports.storage import get_storage
+from reports.dates import output_date, previous_output
+from reports.pools import process_pool
+from reports.history import History, history_path
+
 TABLES = [
     'study',
     'investigator',
@@ -37,29 +45,11 @@ TABLES = [
 
 IGNORE_COLS = ['uuid', 'created_at', 'modified_at', 'kf_id']
 
+# Rows read at a time when summarizing a table in chunks
+CHUNK_SIZE = 10000
 
-def get_pg_connection_str():
-    """
-    Helper function to load database creds from vault
-    """
-    if 'CONN_STR' in os.environ:
-        return os.environ['CONN_STR']
-    env = os.environ.get('ENV')
-    vault_url = os.environ.get('VAULT_URL')
-    path = os.environ.get('DATASERVICE_PG_SECRET')
-
-    session = boto3.Session()
-    client = hvac.Client(url=vault_url)
-    credentials = session.get_credentials()
-    r = client.auth_aws_iam(credentials.access_key,
-                            credentials.secret_key,
-                            credentials.token)
-    secret = client.read(path)['data']
-
-    usr = secret['username']
-    pas = secret['password']
-    host = secret['hostname']
-    return f"postgres://{usr}:{pas}@{host}:5432/kfpostgres{env}"
+NUMERIC_TYPES = ['smallint', 'integer', 'bigint', 'real', 'double precision',
+                 'numeric']
 
 
 def handler(event, context):
@@ -69,34 +59,49 @@ def handler(event, context):
     study_id = event.get('study_id')
     output = event.get('output')
     change_report = event.get('change_report', False)
-    conn_str = get_pg_connection_str()
-
-    g = SummaryGenerator(output=f"/tmp/", conn_str=conn_str)
+    trend_report = event.get('trend_report', False)
+    method = event.get('method', 'table')
+    chunksize = event.get('chunksize', CHUNK_SIZE)
+    workers = event.get('workers', 1)
+    previous = None
+    if event.get('reuse_unchanged', False):
+        previous = 's3://' + previous_output(output)
+    # Outputs are only dated when run by the service, so only read the date
+    # from the output when the history needs it
+    history = None
+    date = datetime.now()
+    if event.get('history', False):
+        history = history_path(output)
+        date = output_date(output)
+    conn_str = credentials.pg_connection_str()
+
+    # Write straight to s3 rather than staging files in /tmp for upload
+    g = SummaryGenerator(output='s3://'+output, conn_str=conn_str,
+                         method=method,
+                         chunksize=chunksize, workers=workers,
+                         previous=previous,
+                         snapshot=event.get('snapshot', False),
+                         csv_export=event.get('csv_export', True),
+                         history=history, date=date.strftime('%Y%m%d'))
     g.make_report()
 
-    # Collect all files in /tmp for upload
-    files = set(glob.glob('/tmp/**/*.png', recursive=True))
-    files = files.union(set(glob.glob('/tmp/**/*.csv', recursive=True)))
-    files = files.union(set(glob.glob('/tmp/**/*.html', recursive=True)))
-
-
+    # Reports of the summaries are only started once today's summary is
+    # saved, so they can't miss it
     if change_report:
-        call_daily_change_report(context.function_name, output)
+        call_daily_change_report(context.function_name, output, history)
+    if trend_report:
+        call_weekly_trend_report(context.function_name, output, history)
 
-    return [], {p.replace('/tmp/', ''): p for p in list(files)}
+    return [], {p: g.storage.url(p) for p in g.storage.written}
 
 
-def call_daily_change_report(function, output):
+def call_daily_change_report(function, output, history=None):
     # Call the ChangeReport lambda
-    bucket = output.replace('s3://', '').split('/')[0]
     # Will upload change report back to the same directory as this report
-    prefix = 's3://' + '/'.join(output.replace('s3://', '').split('/')[1:])
-
-    date = datetime.strptime(prefix.split('/')[-2].replace('-reports', ''),
-                             '%Y%m%d')
+    # The summaries are looked up in the history, if one is kept
+    date = output_date(output)
     yesterday = date - timedelta(days=1)
-    yesterday_path = output.replace(date.strftime('%Y%m%d'),
-                                    yesterday.strftime('%Y%m%d'))
+    yesterday_path = previous_output(output)
 
     payload = {
         "name": "Change Report",
@@ -108,6 +113,12 @@ def call_daily_change_report(function, output):
         "subtitle": f"{yesterday.strftime('%Y%m%d')} to " +
                     f"{date.strftime('%Y%m%d')}",
     }
+    if history is not None:
+        payload.update({
+            "history": history,
+            "date_1": yesterday.strftime('%Y%m%d'),
+            "date_2": date.strftime('%Y%m%d'),
+        })
 
     print('Invoke change report:', json.dumps(payload))
 
@@ -119,47 +130,159 @@ def call_daily_change_report(function, output):
     )
 
 
+def call_weekly_trend_report(function, output, history=None):
+    # Call the TrendReport lambda
+    # Will upload the trend report to a Weekly_Trend directory next to this
+    # report, trending the summaries of the week up to and including today's
+    date = output_date(output)
+    output = output.rstrip('/')
+    payload = {
+        "name": "Weekly Trend",
+        "module": "reports.trend_report",
+        "summary_path": 's3://' + output.replace(date.strftime('%Y%m%d'),
+                                                 '{date}') + '/summaries',
+        "end": date.strftime('%Y%m%d'),
+        "days": 7,
+        "output": output.rsplit('/', 1)[0] + '/Weekly_Trend',
+        "title": "Weekly Trend Report",
+    }
+    if history is not None:
+        payload["history"] = True
+
+    print('Invoke trend report:', json.dumps(payload))
+
+    client = boto3.client('lambda')
+    client.invoke(
+        FunctionName=function,
+        InvocationType='Event',
+        Payload=str.encode(json.dumps(payload))
+    )
+
+
 class SummaryGenerator:
 
-    def __init__(self, study_id=None, output='', conn_str=''):
+    def __init__(self, study_id=None, output='', conn_str='', method='table',
+                 chunksize=CHUNK_SIZE, workers=1, previous=None,
+                 snapshot=False, csv_export=True, history=None, date=None):
         """
         :param study_id: The kf_id of the study to generate a summary for. If
             `None`, the report will be run for all data.
-        :param output: The path to save results to. If run for a specific
-            study, results will be saved within a directory named by the kf_id
-            of that study in this path.
+        :param output: The path or storage to save results to. If run for a
+            specific study, results will be saved within a directory named by
+            the kf_id of that study in this path.
         :param conn_str: The sql connection string for the database
+        :param method: How to summarize each table. `table` reads the whole
+            table into pandas, `pushdown` aggregates the value counts in
+            postgres and only reads the counts, `chunked` streams the table
+            through pandas `chunksize` rows at a time.
+        :param chunksize: The number of rows per chunk for the `chunked`
+            method
+        :param workers: The number of tables to summarize at once. Reading
+            from the database is done in threads and summarizing in pandas
+            in processes.
+        :param previous: The output path or storage of an earlier report.
+            Tables whose fingerprint is the same as in that report reuse its
+            summaries instead of being summarized again, as long as it was
+            made with the same method for the same study.
+        :param snapshot: Whether to save all summaries in a single snapshot
+            in the summaries directory
+        :param csv_export: Whether to save each summary to its own csv in the
+            summaries directory
+        :param history: The path or storage of a history to add the value
+            counts to
+        :param date: The date to add the value counts to the history under,
+            as `YYYYMMDD`. Defaults to today.
         """
+        if method not in ('table', 'pushdown', 'chunked'):
+            raise ValueError(f'unknown summary method {method}')
         self.study_id = study_id
         self.conn_str = conn_str
-        self.output = output
-        if self.study_id is not None:
-            self.output += self.study_id+'/'
-
-        os.makedirs(os.path.join(self.output, 'summaries'), exist_ok=True)
+        self.method = method
+        self.chunksize = chunksize
+        self.workers = workers
+        self.previous = None if previous is None else get_storage(previous)
+        self.snapshot = snapshot
+        self.csv_export = csv_export
+        self.history = None if history is None else History(history)
+        self.date = date or datetime.now().strftime('%Y%m%d')
+        self.storage = get_storage(output)
+        self.prefix = '' if self.study_id is None else self.study_id+'/'
+        self.fingerprints = {}
+        self.previous_fingerprints = {}
+        self._previous_snapshot = None
 
     def make_report(self):
         """
         Compile summaries for all tables and save them
         """
+        self.fingerprints = {table: fingerprint(table, self.conn_str)
+                             for table in TABLES}
+        # Raw csv files of the previous summaries that can be reused
+        reused = {}
+        if self.previous is not None:
+            state = json.loads(
+                self.previous.read(f'{self.prefix}fingerprints.json') or '{}')
+            # Summaries made with another method or for another study are
+            # never reused, even if the tables are unchanged
+            if (state.get('prefix') == self.prefix and
+                    state.get('method') == self.method):
+                self.previous_fingerprints = state.get('tables', {})
+            for table in TABLES:
+                if (self.previous_fingerprints.get(table) ==
+                        self.fingerprints[table]):
+                    reused[table] = self.previous_summaries(table)
+            reused = {k: v for k, v in reused.items() if v}
+            print(f'reusing unchanged summaries for {list(reused.keys())}')
+
+        tables = [table for table in TABLES if table not in reused]
+        if self.workers > 1:
+            with ThreadPoolExecutor(max_workers=self.workers) as threads, \
+                    process_pool(self.workers) as processes:
+                futures = [threads.submit(self.summarize, table, processes)
+                           for table in tables]
+                summaries = {table: future.result()
+                             for table, future in zip(tables, futures)}
+        else:
+            summaries = {}
+            for table in tables:
+                summaries[table] = self.summarize(table)
+
         table_summaries = {}
+        # Contents of each summary csv keyed by table and column
+        files = {}
         for table in TABLES:
-            # Read table from postgres
-            df = pd.read_sql_table(table, con=self.conn_str)
-            table_summaries[table] = table_report(df)
+            if table in reused:
+                table_summaries[table] = {
+                    col: pd.read_csv(io.BytesIO(data), index_col=0)
+                    for col, data in reused[table].items()
+                }
+                files[table] = reused[table]
+            else:
+                table_summaries[table] = summaries[table]
+                files[table] = {col: column.to_csv().encode()
+                                for col, column in summaries[table].items()}
 
         # Save each summary file to csv
-        for table_name, table in table_summaries.items():
-            os.makedirs(os.path.join(self.output,
-                                     'summaries',
-                                     table_name),
-                        exist_ok=True)
-            for col_name, column in table.items():
-                path = os.path.join(self.output,
-                                    'summaries',
-                                    table_name,
-                                    f'{col_name}.csv')
-                column.to_csv(path)
+        for table_name, table in files.items():
+            if not self.csv_export:
+                break
+            for col_name, data in table.items():
+                self.storage.write(
+                    f'{self.prefix}summaries/{table_name}/{col_name}.csv',
+                    data)
+
+        if self.snapshot:
+            for name, data in snapshot.snapshot_files(files).items():
+                self.storage.write(f'{self.prefix}summaries/{name}', data)
+        self.storage.write(f'{self.prefix}summaries/{snapshot.MANIFEST_FILE}',
+                           snapshot.manifest(files))
+        if self.history is not None:
+            self.history.append(self.date, *snapshot.to_snapshot(files))
+
+        state = {'prefix': self.prefix, 'method': self.method,
+                 'tables': self.fingerprints}
+        self.storage.write(f'{self.prefix}fingerprints.json',
+                           json.dumps(state, indent=2))
 
         # Print report to html
         env = Environment(loader=FileSystemLoader(os.path.dirname(os.path.abspath(__file__))))
@@ -175,8 +298,51 @@ class SummaryGenerator:
         # Render and save HTML
         html_out = template.render(template_vars)
         filename = f"Table_Summary_Report_{datetime.now().strftime('%Y%m%d')}.html"
-        with open(self.output+filename, "w+") as f:
-            f.write(html_out)
+        self.storage.write(self.prefix+filename, html_out)
+
+    def previous_summaries(self, table):
+        """
+        Read the raw summary csvs of a table from the previous report
+
+        The csvs are unpacked from the previous report's snapshot if it
+        didn't export them. Returns a dict of file contents keyed by column,
+        which is empty if the previous report has no summaries for the table.
+        """
+        path = f'{self.prefix}summaries/{table}'
+        summaries = {}
+        for name in self.previous.list(path):
+            if name.endswith('.csv'):
+                summaries[name[:-4]] = self.previous.read(f'{path}/{name}')
+        if summaries:
+            return summaries
+
+        if self._previous_snapshot is None:
+            counts = self.previous.read(
+                f'{self.prefix}summaries/{snapshot.COUNTS_FILE}')
+            describe = self.previous.read(
+                f'{self.prefix}summaries/{snapshot.DESCRIBE_FILE}')
+            if counts is None or describe is None:
+                return {}
+            self._previous_snapshot = snapshot.read_snapshot(counts, describe)
+        return snapshot.to_csv_files(*self._previous_snapshot, table)
+
+    def summarize(self, table, pool=None):
+        """
+        Summarize a single table with the configured method
+
+        :param pool: An executor to run the pandas summarizing in, if any
+        """
+        def run(f, *args):
+            return pool.submit(f, *args).result() if pool else f(*args)
+
+        if self.method == 'pushdown':
+            return counts_report(pushdown_counts(table, self.conn_str))
+        if self.method == 'chunked':
+            return counts_report(run(chunked_counts, table, self.conn_str,
+                                     self.chunksize))
+        # Read table from postgres
+        df = pd.read_sql_table(table, con=self.conn_str)
+        return run(table_report, df)
 
 
 def table_report(df):
@@ -187,7 +353,7 @@ def table_report(df):
     """
     reports = {}
     # Get rid of the id and unique columns
-    df = df[list(set(df.columns) - set(IGNORE_COLS))]
+    df = df[[c for c in df.columns if c not in IGNORE_COLS]]
     # Compile the highlevel summary
     reports['summary'] = df.describe(include='all', percentiles=[])
 
@@ -211,6 +377,293 @@ def column_report(df, col):
     return counts
 
 
+def table_schema(table, con):
+    """
+    Get the name and type of each column of a table, in table order
+    """
+    return pd.read_sql_query("""
+        SELECT column_name, data_type FROM information_schema.columns
+        WHERE table_name = %(table)s AND table_schema = current_schema()
+        ORDER BY ordinal_position""", con=con, params={'table': table})
+
+
+def fingerprint(table, con):
+    """
+    Compute a cheap fingerprint of a table's contents from its number of
+    rows, latest modification, and columns
+    """
+    schema = table_schema(table, con)
+    stats = pd.read_sql_query(f"""
+        SELECT count(*) AS rows, max(modified_at) AS modified_at
+        FROM "{table}" """, con=con).iloc[0]
+    columns = ','.join(f'{c}:{t}' for c, t in schema.itertuples(index=False))
+    return {
+        'rows': int(stats['rows']),
+        'modified_at': str(stats['modified_at']),
+        'columns': hashlib.sha1(columns.encode()).hexdigest(),
+    }
+
+
+def pushdown_counts(table, con):
+    """
+    Compute the value counts of every column of a table in postgres
+
+    Each row is unpivoted into one (column, value) pair per column, with
+    the value as text, and the pairs are counted in a single scan of the
+    table. Only one row per distinct value of each column is read back,
+    along with the first row each value is seen in so that ties are
+    ordered as pandas orders them.
+    Returns a dict of value counts keyed by column, ordered as they are by
+    `value_counts`.
+    """
+    schema = table_schema(table, con)
+    schema = schema[~schema['column_name'].isin(IGNORE_COLS)]
+    columns = list(schema['column_name'])
+    if not columns:
+        return {}
+
+    # Values are grouped by their text, so columns without an equality
+    # operator, like json, can be counted too
+    pairs = ', '.join(f'({i}, t."{c}"::text)' for i, c in enumerate(columns))
+    df = pd.read_sql_query(f"""
+        SELECT u.k, u.v, count(*) AS count, min(t.__row) AS first
+        FROM (SELECT *, row_number() OVER () AS __row FROM "{table}") AS t
+        CROSS JOIN LATERAL (VALUES {pairs}) AS u(k, v)
+        GROUP BY u.k, u.v""", con=con)
+
+    counts = {}
+    for i, (col, data_type) in enumerate(schema.itertuples(index=False)):
+        rows = df[df['k'] == i]
+        nulls = rows['v'].isnull()
+        rows = rows[~nulls]
+        values = text_values(rows['v'], data_type, nulls.any())
+        counts[col] = value_counts(col, values, rows['count'], rows['first'])
+    return counts
+
+
+def text_values(values, data_type, nulls):
+    """
+    Convert values read from postgres as text to the dtype pandas would
+    read the whole column with
+
+    Integer and boolean columns are read as ints and bools if they have no
+    nulls, integers as floats and booleans as objects if they have some,
+    and integers as objects if they have nothing but nulls.
+
+    :param values: A series of the distinct values of a column as text
+    :param data_type: The postgres type of the column
+    :param nulls: Whether the column has any nulls
+    """
+    values = values.reset_index(drop=True)
+    integer = data_type in ('smallint', 'integer', 'bigint')
+    if integer and not nulls:
+        return values.astype('int64')
+    if integer and values.empty:
+        return values.astype(object)
+    if data_type in NUMERIC_TYPES:
+        return values.astype('float64')
+    if data_type == 'boolean':
+        values = values.map({'true': True, 'false': False})
+        return values.astype(object if nulls else 'bool')
+    if data_type.startswith('timestamp') or data_type == 'date':
+        return pd.to_datetime(values,
+                              utc=data_type == 'timestamp with time zone')
+    return values
+
+
+def value_counts(col, values, counts, first):
+    """
+    Format the value counts of a column ordered as `value_counts` orders
+    them
+
+    Like `value_counts`, values are listed in the order they're first seen
+    in and then sorted by descending count with the same sort, so ties come
+    out in the same order.
+
+    :param values: The values of the column
+    :param counts: The number of times each value is seen
+    :param first: The position of the first row each value is seen in
+    """
+    df = pd.DataFrame({col: values.reset_index(drop=True),
+                       'count': counts.reset_index(drop=True),
+                       'first': first.reset_index(drop=True)})
+    # Values with different text can be the same value, like numerics
+    # with different scales
+    if df[col].duplicated().any():
+        df = (df.groupby(col, sort=False)
+                .agg({'count': 'sum', 'first': 'min'})
+                .reset_index())
+    df = df.sort_values('first', kind='mergesort').reset_index(drop=True)
+    order = df['count'].sort_values(ascending=False).index
+    return (df.loc[order, [col, 'count']]
+              .astype({'count': 'int64'})
+              .reset_index(drop=True))
+
+
+def chunked_counts(table, con, chunksize=CHUNK_SIZE):
+    """
+    Compute the value counts of every column of a table by streaming it
+    through pandas in chunks
+
+    Rows are read through a server-side cursor and each chunk's value counts
+    are merged into running totals, so memory is bounded by the chunk size
+    and the number of distinct values rather than the size of the table.
+    Returns a dict of value counts keyed by column, ordered as they are by
+    `value_counts`.
+    """
+    totals = {}
+    # Position of the first row each value of a column is seen in
+    firsts = {}
+    # Columns with nulls in any chunk
+    nulls = set()
+
+    def add(chunk, offset):
+        for col in chunk.columns:
+            if col in IGNORE_COLS:
+                continue
+            if chunk[col].isnull().any():
+                nulls.add(col)
+            counts = chunk[col].value_counts()
+            first = chunk[col].reset_index(drop=True).dropna()
+            first = first.drop_duplicates()
+            first = pd.Series(first.index + offset, index=first.values)
+            if col in totals:
+                counts = totals[col].add(counts, fill_value=0)
+                first = pd.concat([firsts[col], first])
+                first = first[~first.index.duplicated()]
+            totals[col] = counts
+            firsts[col] = first
+
+    from sqlalchemy import create_engine
+
+    rows = 0
+    engine = create_engine(con)
+    with engine.connect() as conn:
+        conn = conn.execution_options(stream_results=True)
+        for chunk in pd.read_sql_table(table, con=conn, chunksize=chunksize):
+            add(chunk, rows)
+            rows += len(chunk)
+        # Chunks of an empty table don't get the column dtypes, so read it
+        # whole to describe it the same way
+        if rows == 0:
+            totals.clear()
+            firsts.clear()
+            add(pd.read_sql_table(table, con=conn), 0)
+    engine.dispose()
+
+    counts = {}
+    for col, total in totals.items():
+        total = merged_dtype(total, col in nulls)
+        counts[col] = value_counts(col, total.index.to_series(), total,
+                                   firsts[col].reindex(total.index))
+    return counts
+
+
+def merged_dtype(counts, nulls):
+    """
+    Give value counts merged from chunks the dtype pandas would read the
+    whole column with
+
+    A chunk where a column is all null reads it as objects, which turns
+    the merged values into objects too, and only chunks with nulls read an
+    integer column as floats.
+
+    :param counts: A series of counts indexed by value
+    :param nulls: Whether the column had any nulls
+    """
+    values = pd.Series(counts.index.tolist(), dtype=counts.index.dtype)
+    if values.dtype == object and len(values):
+        values = values.infer_objects()
+        # Booleans with nulls are read as objects
+        if pd.api.types.is_bool_dtype(values) and nulls:
+            values = values.astype(object)
+    if pd.api.types.is_integer_dtype(values) and nulls:
+        values = values.astype('float64')
+    return pd.Series(counts.values, index=pd.Index(values, dtype=values.dtype))
+
+
+def sort_counts(counts):
+    """
+    Order value counts as `column_report` does, by descending count
+    """
+    return (counts.sort_values(counts.columns[0])
+                  .sort_values('count', ascending=False, kind='mergesort')
+                  .reset_index(drop=True))
+
+
+def counts_report(counts):
+    """
+    Compile the same summaries as `table_report` from the value counts of
+    every column of a table
+
+    The counts of each column must be ordered as `value_counts` orders
+    them, which decides the `top` value of ties.
+    """
+    reports = {}
+    reports['summary'] = describe_counts(counts)
+    for name, column in counts.items():
+        if not name.endswith('_id'):
+            reports[name] = sort_counts(column)
+    return reports
+
+
+def describe_counts(counts):
+    """
+    Compute the equivalent of `df.describe(include='all', percentiles=[])`
+    from the value counts of each column
+    """
+    stats = {}
+    for name, column in counts.items():
+        values = column[name]
+        n = column['count']
+        total = int(n.sum())
+        if (pd.api.types.is_numeric_dtype(values) and
+                not pd.api.types.is_bool_dtype(values)):
+            order = np.argsort(values.values, kind='mergesort')
+            values, n = values.values[order], n.values[order]
+            mean = (values * n).sum() / total if total else np.nan
+            std = (np.sqrt((n * (values - mean)**2).sum() / (total - 1))
+                   if total > 1 else np.nan)
+            stats[name] = pd.Series([total, mean, std,
+                                     values.min() if total else np.nan,
+                                     weighted_median(values, n),
+                                     values.max() if total else np.nan],
+                                    index=['count', 'mean', 'std', 'min',
+                                           '50%', 'max'])
+        else:
+            top = column.iloc[n.values.argmax()] if total else None
+            stat = pd.Series([total, len(column),
+                              top[name] if total else np.nan,
+                              top['count'] if total else np.nan],
+                             index=['count', 'unique', 'top', 'freq'],
+                             dtype=object)
+            if pd.api.types.is_datetime64_any_dtype(values):
+                stat['first'] = values.min() if total else np.nan
+                stat['last'] = values.max() if total else np.nan
+            stats[name] = stat
+
+    # Order the stats as pandas does, starting with the shortest description
+    index = []
+    for stat in sorted(stats.values(), key=len):
+        index.extend(i for i in stat.index if i not in index)
+    return pd.DataFrame(stats, index=index, columns=list(counts.keys()))
+
+
+def weighted_median(values, counts):
+    """
+    The median of sorted `values` each repeated `counts` times, interpolated
+    between the middle two values as pandas does
+    """
+    total = counts.sum()
+    if total == 0:
+        return np.nan
+    pos = (total - 1) * 0.5
+    cum = np.cumsum(counts)
+    lo = values[np.searchsorted(cum, np.floor(pos), side='right')]
+    hi = values[np.searchsorted(cum, np.ceil(pos), side='right')]
+    return lo + (hi - lo) * (pos - np.floor(pos))
+
+
 # For local testing
 if __name__ == '__main__':
     handler({"name": "Study Report",
@@ -0,0 +1,229 @@
+import os
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from jinja2 import Environment, FileSystemLoader
+
+from reports import snapshot
+from reports.storage import get_storage
+from reports.history import History, history_path
+from reports.dates import output_date
+from reports.change_report import SUMMARY_RE
+
+# Number of summaries loaded at once
+WORKERS = 8
+# Number of days a trend covers when no range is given
+DAYS = 7
+
+
+def handler(event, context):
+    """
+    Create a trend report of the value counts of every column over a series
+    of summaries
+
+    The event param should be formatted as:
+    {
+        "summary_paths": [String],
+        "summary_path": String,
+        "start": String,
+        "end": String,
+        "days": Integer,
+        "output": String,
+        "title": String
+    }
+
+    Where `summary_paths` are the local or s3 paths of the summaries, in
+    order. If not given, a summary is taken for each day from `start` to
+    `end`, formatted as `YYYYMMDD`, by formatting the `{date}` in
+    `summary_path`. The range defaults to the `days` up to the date of this
+    report, and `summary_path` to the Table Summary report of each day in the
+    same bucket as `output`. If `history` is set, the summaries of each day
+    are looked up in the history kept in the bucket instead, falling back to
+    the summary path of any day the history doesn't have.
+    The Table Summary report starts this report once its summary is saved
+    if it's run with `trend_report`.
+    `output` is the s3 path to save the trend tables and report to.
+    `title` is a description of the report.
+
+    Summaries are formatted as described by the change report.
+    """
+    output = event.get('output')
+    title = event.get('title', 'Trend Report')
+    if event.get('history', False):
+        history = History(history_path(output))
+        summaries = {}
+        for date, path in summary_paths(event, output).items():
+            summary = history.summary(date)
+            # Dates from before the history was kept are only in the
+            # summaries
+            summaries[date] = summary if summary.list() else path
+    else:
+        summaries = (event.get('summary_paths') or
+                     summary_paths(event, output))
+
+    g = TrendGenerator(summaries, output='s3://'+output, title=title,
+                       subtitle=event.get('subtitle', ''),
+                       workers=event.get('workers', WORKERS))
+    g.make_report()
+
+    return [], {p: g.output.url(p) for p in g.output.written}
+
+
+def summary_paths(event, output):
+    """
+    Find the path of the summary of each day in the range of a report
+
+    :returns: The path of each summary keyed by its date
+    """
+    end = (datetime.strptime(event['end'], '%Y%m%d') if 'end' in event
+           else output_date(output))
+    start = (datetime.strptime(event['start'], '%Y%m%d') if 'start' in event
+             else end - timedelta(days=event.get('days', DAYS) - 1))
+    bucket = output.replace('s3://', '').split('/')[0]
+    path = event.get('summary_path',
+                     f's3://{bucket}/{{date}}-reports/Table_Summary/summaries')
+
+    dates = [(start + timedelta(days=i)).strftime('%Y%m%d')
+             for i in range((end - start).days + 1)]
+    return {date: path.format(date=date) for date in dates}
+
+
+class TrendGenerator:
+
+    def __init__(self, summaries, output='/tmp/', title='Trend Report',
+                 subtitle='', workers=WORKERS):
+        """
+        :param summaries: The paths or storages of the summaries, in order,
+            or a dict of them keyed by the label to show for each
+        :param output: The path or storage to output all trend tables to
+        :param workers: Number of summaries to load at once
+        """
+        if not isinstance(summaries, dict):
+            summaries = {str(path): path for path in summaries}
+        self.summaries = summaries
+        self.output = get_storage(output)
+        self.title = title
+        self.subtitle = subtitle
+        self.workers = workers
+
+    def make_report(self):
+        """
+        Compile the trend of every column and save them
+        """
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            counts = dict(zip(self.summaries,
+                              pool.map(load_counts,
+                                       self.summaries.values())))
+        missing = [label for label, c in counts.items() if c is None]
+        if missing:
+            print(f'No summaries found for {missing}')
+        counts = {label: c for label, c in counts.items() if c is not None}
+        if len(counts) < 2:
+            raise IOError('Need at least two summaries to show a trend')
+
+        trends, totals = trend_tables(align_counts(counts))
+        for (table, column), trend in trends.items():
+            self.output.write(f'trends/{table}/{column}_trend.csv',
+                              trend.to_csv(index=False))
+
+        sections = {table: {} for table in totals}
+        for (table, column), trend in trends.items():
+            sections[table][column] = (trend.style
+                .set_table_attributes(
+                    'class="table table-striped table-hover"'))
+
+        env = Environment(loader=FileSystemLoader(os.path.dirname(os.path.abspath(__file__))))
+        template = env.get_template("summary_template.html")
+
+        template_vars = {
+            "title": self.title,
+            "subtitle": self.subtitle or f'{list(counts)[0]} to '
+                                         f'{list(counts)[-1]}',
+            "date": datetime.now(),
+            "sections": sections,
+            "counts": totals
+        }
+        # Render and save HTML
+        html_out = template.render(template_vars)
+        title = self.title.lower().replace(' ', '_')
+        self.output.write(f"{title}.html", html_out)
+
+
+def load_counts(path):
+    """
+    Load the value counts of every column in a summary, from its snapshot if
+    it has one or else from its csvs
+
+    Values are kept as the text they have in the csvs.
+
+    :returns: A dataframe of (table, column, value, count), or None if there
+        are no summaries at the path
+    """
+    storage = get_storage(path)
+    data = storage.read(snapshot.COUNTS_FILE)
+    if data is not None:
+        counts = snapshot.read_counts(data)
+    else:
+        names = [n for n in storage.list(recursive=True)
+                 if SUMMARY_RE.match(n) and n.split('/')[1] != 'summary.csv']
+        if not names:
+            return None
+        files = {}
+        for name, data in storage.read_many(names).items():
+            table, column = name[:-len('.csv')].split('/')
+            files.setdefault(table, {})[column] = data
+        counts = snapshot.to_snapshot(files)[0]
+        counts['count'] = counts['count'].astype('int64')
+    # Drop the placeholders of columns without any values
+    return counts[counts['count'] > 0]
+
+
+def align_counts(counts):
+    """
+    Align the value counts of many summaries in one wide table
+
+    :param counts: The value counts of each summary keyed by its label
+    :returns: A dataframe indexed by table, column, and value with the count
+        in each summary as a column, in the order of `counts`
+    """
+    long = pd.concat(list(counts.values()), keys=list(counts),
+                     names=['summary'])
+    long = long.reset_index(level=0)
+    wide = long.pivot_table(index=['table', 'column', 'value'],
+                            columns='summary', values='count',
+                            aggfunc='sum', fill_value=0)
+    return wide.reindex(columns=list(counts), fill_value=0)
+
+
+def trend_tables(wide):
+    """
+    Compute the net and gross change of every value over the summaries
+
+    Net change is between the first and last summary, gross change is the
+    sum of the changes between each summary and the next.
+
+    :returns: A dict keyed by table and column of the trend of each value
+        that changed, and a dict keyed by table of the net and gross change
+        of each column
+    """
+    wide = wide.copy()
+    labels = list(wide.columns)
+    wide['net'] = wide[labels[-1]] - wide[labels[0]]
+    wide['gross'] = wide[labels].diff(axis=1).abs().sum(axis=1).astype('int64')
+
+    totals = (wide[['net', 'gross']].groupby(level=['table', 'column']).sum()
+                                    .reset_index(level='column'))
+    totals = {table: df.reset_index(drop=True)
+              for table, df in totals.groupby(level='table')}
+
+    trends = {}
+    changed = wide[wide['gross'] > 0].reset_index()
+    for (table, column), trend in changed.groupby(['table', 'column']):
+        trends[(table, column)] = (trend.drop(['table', 'column'], axis=1)
+                                        .rename(columns={'value': column})
+                                        .sort_values(['gross', 'net'],
+                                                     ascending=False)
+                                        .reset_index(drop=True))
+    return trends, totals
@@ -0,0 +1,110 @@
+import os
+import glob
+import shutil
+import tempfile
+
+# Directory workspaces are made in
+ROOT = '/tmp'
+# Prefix of the names of workspace directories
+PREFIX = 'report-'
+# Bytes of disk a workspace may use, leaving room in the 512MB of a lambda's
+# /tmp for anything else
+BUDGET = 384 * 1024 * 1024
+
+
+class WorkspaceFull(IOError):
+    """ A workspace has used up its disk budget """
+
+
+class Workspace:
+    """
+    A scratch directory for the files of one report invocation
+
+    Lambda containers are reused between invocations, so anything left in
+    /tmp is seen again by later reports. Each invocation gets a directory
+    of its own instead, which lists only the files made by that invocation
+    and is removed afterwards. Workspaces left by invocations that didn't
+    finish are removed when the next one is made.
+    """
+
+    def __init__(self, path=None, root=ROOT, budget=BUDGET):
+        """
+        :param path: An existing workspace to use, as given to a report in
+            the `workspace` of its event. A new one is made if not given.
+        :param root: The directory to make a new workspace in
+        :param budget: Bytes of disk the workspace may use
+        """
+        if path is None:
+            sweep(root)
+            os.makedirs(root, exist_ok=True)
+            path = tempfile.mkdtemp(prefix=PREFIX, dir=root)
+        self.path = path
+        self.budget = budget
+
+    @classmethod
+    def from_event(cls, event):
+        """
+        Get the workspace of a report's event, or a new one if it has none,
+        as when running a report locally
+        """
+        return cls(event.get('workspace'))
+
+    def file(self, name):
+        """
+        Get the path to write a file of the workspace to, making its
+        directory
+
+        Raises WorkspaceFull if the workspace has used up its budget.
+        """
+        self.check()
+        path = os.path.join(self.path, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def files(self, *extensions):
+        """
+        List the paths of the files in the workspace
+
+        :param extensions: Only list files with these extensions
+        """
+        paths = [os.path.join(d, name)
+                 for d, _, names in os.walk(self.path) for name in names]
+        if extensions:
+            paths = [p for p in paths if p.endswith(extensions)]
+        return sorted(paths)
+
+    def name(self, path):
+        """ Get the name of a file relative to the workspace """
+        return os.path.relpath(path, self.path).replace(os.sep, '/')
+
+    def usage(self):
+        """ Count the bytes of disk used by the files of the workspace """
+        return sum(os.path.getsize(p) for p in self.files())
+
+    def check(self):
+        """ Raise WorkspaceFull if the workspace is over its budget """
+        usage = self.usage()
+        if usage > self.budget:
+            raise WorkspaceFull(f'{self.path} uses {usage} bytes, over its '
+                                f'budget of {self.budget}')
+
+    def cleanup(self):
+        """ Remove the workspace and all of its files """
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.cleanup()
+
+
+def sweep(root=ROOT):
+    """
+    Remove the workspaces left in a directory by earlier invocations
+
+    A container runs one invocation at a time, so any workspace already
+    there when a new one is made is stale.
+    """
+    for path in glob.glob(os.path.join(root, PREFIX + '*')):
+        shutil.rmtree(path, ignore_errors=True)
@@ -1,11 +1,35 @@
 import os
+import gzip
+import json
+import shutil
+import hashlib
+import tempfile
 import traceback
 import sys
 import time
-from base64 import b64decode
+from concurrent.futures import ThreadPoolExecutor
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from boto3.s3.transfer import TransferConfig
 from botocore.vendored import requests
 
+from reports import credentials
+from reports.storage import content_type, content_encoding
+from reports.dates import previous_output
+from reports.workspace import Workspace
+
+# Number of files uploaded to s3 at once
+UPLOAD_WORKERS = 16
+# Files are uploaded in parallel already, so each file only gets a couple of
+# threads for its parts when it's large enough for a multipart upload
+TRANSFER_CONFIG = TransferConfig(multipart_threshold=8 * 1024 * 1024,
+                                 multipart_chunksize=8 * 1024 * 1024,
+                                 max_concurrency=2)
+# Hashes of the files uploaded to each output, used to copy files that
+# haven't changed since the previous run instead of uploading them again
+MANIFEST_FILE = 'upload_manifest.json'
+
 
 def handler(event, context):
     """
@@ -13,9 +37,8 @@ def handler(event, context):
     """
     t0 = time.time()
     if 'SLACK_SECRET' in os.environ and 'SLACK_CHANNEL' in os.environ:
-        kms = boto3.client('kms', region_name='us-east-1')
         SLACK_SECRET = os.environ.get('SLACK_SECRET', None)
-        SLACK_TOKEN = kms.decrypt(CiphertextBlob=b64decode(SLACK_SECRET)).get('Plaintext', None).decode('utf-8')
+        SLACK_TOKEN = credentials.kms_decrypt(SLACK_SECRET)
         SLACK_CHANNEL = os.environ.get('SLACK_CHANNEL', '').split(',')
         SLACK_CHANNEL = [c.replace('#','').replace('@','') for c in SLACK_CHANNEL]
 
@@ -32,6 +55,10 @@ def handler(event, context):
     module = __import__(package, globals(), locals(), [sub], 0)
     print('calling', module)
 
+    # Reports write their files to a scratch directory of this invocation
+    workspace = Workspace()
+    event = dict(event, workspace=workspace.path)
+
     failed = False
     at = []
     try:
@@ -82,9 +109,20 @@ def handler(event, context):
             }
         ]
 
-    # Upload files to s3
-    for name, path in files.items():
-        upload_to_s3(path, output)
+    # Upload files to s3, skipping those the report wrote there itself
+    try:
+        failures = upload_files([path for path in files.values()
+                                 if not path.startswith('s3://')], output,
+                                root=workspace.path)
+    finally:
+        workspace.cleanup()
+    if failures:
+        at.append({
+            "fallback": f"{len(failures)} files failed to upload",
+            "title": f":warning: {len(failures)} files failed to upload",
+            "text": "\n".join(f"{path}: {err}" for path, err in failures),
+            "color": "warning"
+        })
 
     if not at:
         return
@@ -124,35 +162,146 @@ def upload_to_slack(name, path, SLACK_TOKEN, SLACK_CHANNEL):
                       files={'file': (path, open(path, 'rb'))})
 
 
-def upload_to_s3(path, output):
+def upload_files(paths, output, workers=UPLOAD_WORKERS, client=None,
+                 root='/tmp/'):
+    """
+    Upload many files to s3 at once with one shared client
+
+    The hash of every file uploaded is saved in a manifest in the output.
+    Files with the same hash in the manifest of the previous day's run of
+    the report are copied from it within s3 rather than uploaded again. A
+    file that fails to upload doesn't stop the others.
+
+    :param paths: Local paths of the files
+    :param output: The bucket and prefix to upload to
+    :param workers: Number of files uploaded at once
+    :param root: The directory files are keyed relative to
+    :returns: A list of (path, error) of the files that failed to upload
+    """
+    if not paths:
+        return []
+    connections = workers * TRANSFER_CONFIG.max_request_concurrency
+    s3 = client or boto3.client('s3', config=Config(
+        max_pool_connections=connections))
+
     bucket = output.split('/')[0]
-    key = '/'.join(output.split('/')[1:] + [path.replace('/tmp/', '')])
-    content = None
-
-    if key.endswith('gz'):
-        content = None
-    elif key.endswith('json'):
-        content = 'application/json'
-    elif key.endswith('png'):
-        content = 'image/png'
-    elif key.endswith('jpg') or key.endswith('.jpeg'):
-        content = 'image/jpeg'
-    elif key.endswith('csv'):
-        content = 'text/csv'
-    if key.endswith('pdf'):
-        content = 'application/pdf'
-    if key.endswith('html') or key.endswith('htm'):
-        content = 'text/html'
-    else:
-        content = 'text/plain'
+    previous = previous_upload(output)
+    previous_hashes = read_manifest(s3, previous) if previous else {}
+    hashes = {}
+
+    def upload(path):
+        try:
+            name = os.path.relpath(path, root)
+            digest = file_hash(path)
+            if (previous_hashes.get(name) == digest and
+                    copy_from_previous(s3, name, previous, output)):
+                print(f'{name} is unchanged, copied from {previous}')
+            else:
+                upload_to_s3(path, output, s3, name)
+            hashes[name] = digest
+        except Exception as err:
+            print(f'failed to upload {path}: {err}')
+            return path, err
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        failures = [failed for failed in pool.map(upload, paths) if failed]
+
+    manifest = read_manifest(s3, output)
+    manifest.update(hashes)
+    s3.put_object(Bucket=bucket, Key=upload_key(output, MANIFEST_FILE),
+                  Body=json.dumps(manifest, indent=2, sort_keys=True),
+                  ContentType='application/json')
+    return failures
+
+
+def upload_key(output, name):
+    """ Get the key of a file in an output """
+    return '/'.join(output.split('/')[1:] + [name])
+
+
+def previous_upload(output):
+    """
+    Get the output of the previous day's run of a report, or None if the
+    output isn't a dated report directory
+    """
+    try:
+        return previous_output(output)
+    except (ValueError, IndexError):
+        return None
 
-    args = None
-    if content:
-        args = {'ContentType': content}
 
-    s3 = boto3.client('s3')
-    s3.upload_file(path, Bucket=bucket, Key=key,
-                   ExtraArgs=args)
+def read_manifest(s3, output):
+    """
+    Read the hashes of the files uploaded to an output, keyed by the name
+    of each file within the output
+    """
+    try:
+        resp = s3.get_object(Bucket=output.split('/')[0],
+                             Key=upload_key(output, MANIFEST_FILE))
+    except s3.exceptions.NoSuchKey:
+        return {}
+    return json.loads(resp['Body'].read())
+
+
+def file_hash(path):
+    """ Hash the contents of a file """
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def copy_from_previous(s3, name, previous, output):
+    """
+    Copy a file from the previous run of a report within s3, keeping its
+    content type and encoding
+
+    :returns: False if the previous file no longer exists
+    """
+    source = {'Bucket': previous.split('/')[0],
+              'Key': upload_key(previous, name)}
+    try:
+        s3.copy(source, output.split('/')[0], upload_key(output, name),
+                Config=TRANSFER_CONFIG)
+    except ClientError as err:
+        if err.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            return False
+        raise
+    return True
+
+
+def upload_to_s3(path, output, client=None, name=None):
+    """
+    Upload a file to s3
+
+    Text files are gzipped and stored with a Content-Encoding, so browsers
+    decompress them as they download.
+
+    :param client: The s3 client to use, a new one if not given
+    :param name: The name to key the file by in the output, defaults to
+        its path relative to /tmp/
+    """
+    bucket = output.split('/')[0]
+    key = upload_key(output, name or path.replace('/tmp/', ''))
+    args = {'ContentType': content_type(key)}
+
+    s3 = client or boto3.client('s3')
+    encoding = content_encoding(key)
+    if encoding is None:
+        s3.upload_file(path, Bucket=bucket, Key=key, ExtraArgs=args,
+                       Config=TRANSFER_CONFIG)
+        return
+
+    args['ContentEncoding'] = encoding
+    with tempfile.SpooledTemporaryFile(max_size=TRANSFER_CONFIG
+                                       .multipart_threshold) as buf:
+        with open(path, 'rb') as src, \
+                gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as dst:
+            shutil.copyfileobj(src, dst)
+        buf.seek(0)
+        s3.upload_fileobj(buf, bucket, key, ExtraArgs=args,
+                          Config=TRANSFER_CONFIG)
 
 
 
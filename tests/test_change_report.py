@@ -1,12 +1,15 @@
 import boto3
+import io
 import os
 import pytest
+import pandas as pd
 from moto import mock_s3
 
 import matplotlib
 matplotlib.use('TkAgg')
 
-from reports import change_report
+from reports import change_report, snapshot, summary_report
+from reports.storage import MemoryStorage, get_storage
 
 
 @pytest.fixture
@@ -25,6 +28,26 @@ def objects():
     return f
 
 
+def summary_files(name):
+    """ Read the contents of a test summary's csvs keyed by table and column """
+    path = os.path.join('tests/data/change_report', name)
+    files = {}
+    for table in os.listdir(path):
+        files[table] = {}
+        for f in os.listdir(os.path.join(path, table)):
+            with open(os.path.join(path, table, f), 'rb') as data:
+                files[table][f.split('.')[0]] = data.read()
+    return files
+
+
+def memory_summary(files):
+    """ Save summary csvs to an in-memory storage """
+    storage = MemoryStorage()
+    for table, columns in files.items():
+        for column, data in columns.items():
+            storage.write(f'{table}/{column}.csv', data)
+    return storage
+
 
 def test_invalid_dir():
     """ Test that non-existant directories fail """
@@ -108,3 +131,195 @@ def test_make_report(tmpdir):
     g = change_report.ChangeGenerator(path_1, path_2, output=p)
     g.make_report()
     assert os.path.isfile(p+'/change_report.html')
+
+
+def test_snapshot_diffs(tmpdir):
+    """ Test that snapshots are diffed the same as trees of csvs """
+    paths = []
+    for name in ['summary_1', 'summary_2']:
+        d = tmpdir.mkdir(name)
+        for fname, data in snapshot.snapshot_files(
+                summary_files(name)).items():
+            d.join(fname).write_binary(data)
+        paths.append(str(d))
+    p = tmpdir.mkdir("output")
+
+    g = change_report.ChangeGenerator(*paths, output=p)
+    expected = change_report.ChangeGenerator(
+        'tests/data/change_report/summary_1/',
+        'tests/data/change_report/summary_2/', output=p)
+    assert sorted(g.tables['added']) == sorted(expected.tables['added'])
+    assert {t: {k: sorted(v) for k, v in c.items()}
+            for t, c in g.columns.items()} == \
+           {t: {k: sorted(v) for k, v in c.items()}
+            for t, c in expected.columns.items()}
+
+    tables, counts = g.compute_diffs()
+    expected_tables, expected_counts = expected.compute_diffs()
+    assert counts == expected_counts
+    df = tables['biospecimens']['composition']
+    assert df[df['composition'] == 'Blood']['change'].iloc[0] == 15
+
+
+@mock_s3
+def test_s3_summaries(tmpdir):
+    """ Test that only the summary csvs are read from s3 """
+    client = boto3.client('s3', region_name='us-east-1')
+    client.create_bucket(Bucket='tests')
+    for name in ['summary_1', 'summary_2']:
+        path = os.path.join('tests/data/change_report', name)
+        for table in os.listdir(path):
+            for f in os.listdir(os.path.join(path, table)):
+                client.upload_file(os.path.join(path, table, f), 'tests',
+                                   f'{name}/summaries/{table}/{f}')
+        client.put_object(Bucket='tests', Key=f'{name}/report.html', Body=b'')
+        client.put_object(Bucket='tests', Key=f'{name}/summaries/plot.png',
+                          Body=b'')
+    client.create_bucket(Bucket='empty')
+    p = str(tmpdir.mkdir("output")) + '/'
+
+    g = change_report.ChangeGenerator('s3://tests/summary_1/summaries',
+                                      's3://tests/summary_2/summaries/',
+                                      output=p, workers=2)
+    assert sorted(g.path_1.list()) == ['biospecimens/', 'participants/']
+    assert sorted(g.path_2.files) == ['biospecimens/analyte_type.csv',
+                                      'biospecimens/composition.csv',
+                                      'diagnoses/diagnosis_category.csv']
+    assert g.tables['same'] == ['biospecimens']
+    assert os.listdir(p) == []
+
+    # Missing summaries fail on s3 as they do on disk
+    p = str(tmpdir.mkdir("empty")) + '/'
+    with pytest.raises(IOError) as err:
+        change_report.ChangeGenerator('s3://empty/summaries',
+                                      's3://tests/summary_2/summaries/',
+                                      output=p)
+    assert 'provide valid' in str(err.value)
+    assert not get_storage('s3://tests/summary_3').exists()
+    assert not get_storage('s3://empty/').exists()
+
+
+def test_memory_report():
+    """ Test that a change report can be made entirely in memory """
+    summaries = [memory_summary(summary_files(name))
+                 for name in ['summary_1', 'summary_2']]
+    output = MemoryStorage()
+
+    g = change_report.ChangeGenerator(*summaries, output=output)
+    g.make_report()
+    assert output.written == ['diffs/biospecimens/composition_diff.csv',
+                              'change_report.html']
+
+
+def test_manifest_skips_identical(monkeypatch):
+    """ Test that columns with the same digest are counted without a diff """
+    summaries = []
+    for name in ['summary_1', 'summary_2']:
+        files = summary_files(name)
+        files['biospecimens']['unchanged'] = b',unchanged,count\n0,a,1\n'
+        storage = memory_summary(files)
+        storage.write(snapshot.MANIFEST_FILE, snapshot.manifest(files))
+        summaries.append(storage)
+
+    read = []
+    read_summary = change_report.ChangeGenerator.read_summary
+    monkeypatch.setattr(change_report.ChangeGenerator, 'read_summary',
+                        lambda self, storage, table, column: read.append(
+                            column) or read_summary(self, storage, table,
+                                                    column))
+
+    g = change_report.ChangeGenerator(*summaries, output=MemoryStorage())
+    assert sorted(g.columns['biospecimens']['same']) == ['composition',
+                                                         'unchanged']
+    tables, counts = g.compute_diffs()
+    assert read == ['composition', 'composition']
+    assert counts['biospecimens'] == {'composition': 2038, 'unchanged': 0}
+    assert list(tables['biospecimens']) == ['composition']
+
+
+def test_parallel_diffs():
+    """ Test that diffing in processes matches diffing serially """
+    files_1, files_2 = summary_files('summary_1'), summary_files('summary_2')
+    for i in range(4):
+        files_1['biospecimens'][f'copy_{i}'] = (
+            files_1['biospecimens']['composition']
+            .replace(b'composition', f'copy_{i}'.encode()))
+        files_2['biospecimens'][f'copy_{i}'] = (
+            files_2['biospecimens']['composition']
+            .replace(b'composition', f'copy_{i}'.encode()))
+    # A column that can't be diffed shouldn't stop the others
+    files_1['biospecimens']['broken'] = b',broken\n0,a\n'
+    files_2['biospecimens']['broken'] = b',broken\n0,b\n'
+
+    results = []
+    for workers in [1, 2]:
+        g = change_report.ChangeGenerator(memory_summary(files_1),
+                                          memory_summary(files_2),
+                                          output=MemoryStorage(),
+                                          diff_workers=workers, chunksize=2)
+        results.append(g.compute_diffs())
+        assert list(g.errors) == [('biospecimens', 'broken')]
+        assert 'KeyError' in g.errors[('biospecimens', 'broken')]
+
+    (tables_1, counts_1), (tables_2, counts_2) = results
+    assert counts_1 == counts_2
+    assert list(tables_1['biospecimens']) == list(tables_2['biospecimens'])
+    assert len(tables_2['biospecimens']) == 5
+    for column, diff in tables_1['biospecimens'].items():
+        assert diff.equals(tables_2['biospecimens'][column])
+
+
+def snapshot_summary(files):
+    """ Save summary csvs to an in-memory storage as a snapshot """
+    storage = MemoryStorage()
+    for name, data in snapshot.snapshot_files(files).items():
+        storage.write(name, data)
+    return storage
+
+
+@pytest.mark.parametrize('summary', [memory_summary, snapshot_summary])
+def test_describe_diffs(summary):
+    """ Test that table summaries are diffed stat by stat """
+    df = pd.DataFrame({
+        'gender': ['Male', 'Female', 'Male', None],
+        'age': [10, 20, 20, 30],
+        'removed': ['a', 'b', 'b', 'b'],
+    })
+    files_1 = {'participants': {
+        'summary': summary_report.table_report(df)['summary'].to_csv()
+                                                            .encode()}}
+    df = pd.concat([df.drop('removed', axis=1),
+                    pd.DataFrame([{'gender': 'Female', 'age': 45,
+                                   'added': 1.5},
+                                  {'gender': 'Female', 'age': 45}])],
+                   ignore_index=True)
+    files_2 = {'participants': {
+        'summary': summary_report.table_report(df)['summary'].to_csv()
+                                                            .encode()}}
+
+    g = change_report.ChangeGenerator(summary(files_1), summary(files_2),
+                                      output=MemoryStorage())
+    tables, counts = g.compute_diffs()
+    assert counts == {'participants': {}}
+    diff = tables['participants']['summary']
+    assert list(diff.columns) == ['gender', 'age', 'added', 'removed']
+    assert diff.loc['count', 'gender'] == \
+        '5 (<span class="text-success">+2</span>)'
+    assert diff.loc['unique', 'gender'] == '2'
+    assert diff.loc['mean', 'age'] == \
+        '28.333333333333332 (<span class="text-success">+8.333333</span>)'
+    assert diff.loc['min', 'age'] == '10.0'
+    assert diff.loc['count', 'added'] == \
+        '<span class="text-success">1.0</span>'
+    assert diff.loc['top', 'removed'] == '<span class="text-danger">(-b)</span>'
+
+    plain = pd.read_csv(io.BytesIO(
+        g.output.files['diffs/participants/summary_diff.csv']), index_col=0)
+    assert plain.loc['top', 'gender'] == 'Female (-Male)'
+    assert plain.loc['count', 'gender'] == '5 (+2)'
+
+    # Identical summaries aren't reported
+    g = change_report.ChangeGenerator(memory_summary(files_1),
+                                      memory_summary(files_1),
+                                      output=MemoryStorage())
+    assert g.compute_diffs()[0] == {}
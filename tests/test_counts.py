@@ -0,0 +1,110 @@
+import sqlite3
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+
+from reports import counts
+
+# A small dataservice database, as (table, columns, rows)
+TABLES = [
+    ('study', ['kf_id', 'investigator_id', 'created_at'],
+     [('SD_1', 'IG_1', 1), ('SD_2', 'IG_2', 2), ('SD_3', None, 3)]),
+    ('study_file', ['kf_id', 'study_id'],
+     [('SF_1', 'SD_1'), ('SF_2', 'SD_1')]),
+    ('participant', ['kf_id', 'study_id', 'family_id'],
+     [('PT_1', 'SD_1', 'FM_1'), ('PT_2', 'SD_1', 'FM_1'),
+      ('PT_3', 'SD_2', 'FM_2')]),
+    ('family_relationship', ['kf_id', 'participant1_id', 'participant2_id'],
+     [('FR_1', 'PT_1', 'PT_2')]),
+    ('diagnosis', ['kf_id', 'participant_id'],
+     [('DG_1', 'PT_1'), ('DG_2', 'PT_3')]),
+    ('phenotype', ['kf_id', 'participant_id'], [('PH_1', 'PT_2')]),
+    ('outcome', ['kf_id', 'participant_id'], []),
+    ('biospecimen', ['kf_id', 'participant_id', 'sequencing_center_id'],
+     [('BS_1', 'PT_1', 'SC_1'), ('BS_2', 'PT_2', 'SC_1'),
+      ('BS_3', 'PT_3', 'SC_2')]),
+    ('genomic_file', ['kf_id', 'data_type', 'sequencing_experiment_id'],
+     [('GF_1', 'Aligned Reads', 'SE_1'), ('GF_2', 'Aligned Reads', 'SE_1'),
+      ('GF_3', 'gVCF', 'SE_2'), ('GF_4', 'Aligned Reads', None)]),
+    # GF_1 was sequenced from two biospecimens of the same study
+    ('biospecimen_genomic_file', ['kf_id', 'biospecimen_id',
+                                  'genomic_file_id'],
+     [('BG_1', 'BS_1', 'GF_1'), ('BG_2', 'BS_2', 'GF_1'),
+      ('BG_3', 'BS_2', 'GF_2'), ('BG_4', 'BS_1', 'GF_3'),
+      ('BG_5', 'BS_3', 'GF_4')]),
+    ('cavatica_task', ['kf_id', 'cavatica_app_id'],
+     [('CT_1', 'CA_1'), ('CT_2', 'CA_1'), ('CT_3', 'CA_2')]),
+    ('cavatica_task_genomic_file', ['kf_id', 'cavatica_task_id',
+                                    'genomic_file_id'],
+     [('CTG_1', 'CT_1', 'GF_1'), ('CTG_2', 'CT_2', 'GF_2'),
+      ('CTG_3', 'CT_3', 'GF_4')]),
+]
+
+# The totals the api gives for each endpoint filtered by each study
+API_TOTALS = {
+    'SD_1': {'/investigators': 1, '/study-files': 2, '/families': 1,
+             '/family-relationships': 1, '/cavatica-apps': 1,
+             '/sequencing-centers': 1, '/participants': 2, '/diagnoses': 1,
+             '/phenotypes': 1, '/outcomes': 0, '/biospecimens': 2,
+             '/genomic-files': 3, '/sequencing-experiments': 2,
+             '/cavatica-tasks': 2, '/cavatica-task-genomic-files': 2},
+    'SD_2': {'/investigators': 1, '/study-files': 0, '/families': 1,
+             '/family-relationships': 0, '/cavatica-apps': 1,
+             '/sequencing-centers': 1, '/participants': 1, '/diagnoses': 1,
+             '/phenotypes': 0, '/outcomes': 0, '/biospecimens': 1,
+             '/genomic-files': 1, '/sequencing-experiments': 0,
+             '/cavatica-tasks': 1, '/cavatica-task-genomic-files': 1},
+    'SD_3': {},
+}
+
+
+class FakeApi:
+    """
+    A dataservice client answering `limit=1` requests with the total of
+    each endpoint, filtered by study and optionally data type
+    """
+    concurrency = 1
+
+    def __init__(self, totals):
+        """
+        :param totals: A function of the endpoint and query params giving
+            the total
+        """
+        self.totals = totals
+
+    def get_many(self, urls):
+        results = []
+        for url in urls:
+            parsed = urlparse(url)
+            params = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+            results.append({'total': self.totals(parsed.path, params)})
+        return results
+
+
+@pytest.fixture
+def dataservice_db(tmpdir):
+    """ Get the connection string of a small dataservice database """
+    path = str(tmpdir.join('dataservice.db'))
+    conn = sqlite3.connect(path)
+    for table, columns, rows in TABLES:
+        conn.execute(f'CREATE TABLE {table} ({", ".join(columns)})')
+        conn.executemany(f'INSERT INTO {table} VALUES '
+                         f'({", ".join("?" for _ in columns)})', rows)
+    conn.commit()
+    conn.close()
+    return f'sqlite:///{path}'
+
+
+def test_by_study_sql(dataservice_db):
+    """
+    Test that the sql backend counts the same entities as the api
+    """
+    endpoints = list(API_TOTALS['SD_1'])
+    client = FakeApi(lambda endpoint, params:
+                     API_TOTALS[params['study_id']].get(endpoint, 0))
+    expected = counts.by_study(client, endpoints, list(API_TOTALS))
+
+    result = counts.by_study_sql(dataservice_db, endpoints)
+
+    assert list(result) == ['SD_1', 'SD_2', 'SD_3']
+    assert result == expected
@@ -0,0 +1,206 @@
+import sys
+import types
+
+import pytest
+
+from reports import credentials
+
+
+class FakeVault:
+    """ A vault client that counts the secrets read from it """
+    reads = 0
+
+    def __init__(self, url=None):
+        pass
+
+    def auth_aws_iam(self, *args):
+        pass
+
+    lease = 100
+
+    def read(self, path):
+        FakeVault.reads += 1
+        return {'lease_duration': FakeVault.lease,
+                'data': {'hostname': 'db',
+                         'username': f'user{FakeVault.reads}',
+                         'password': f'pass{FakeVault.reads}'}}
+
+
+class FakeError(Exception):
+    """ Stands in for psycopg2.OperationalError """
+
+
+class FakeConnection:
+    """ A database connection that keeps track of how it's used """
+
+    def __init__(self, credentials):
+        self.credentials = credentials
+        self.closed = 0
+        self.broken = False
+        self.resets = 0
+
+    def cursor(self):
+        conn = self
+
+        class Cursor:
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+            def execute(self, sql):
+                if conn.broken:
+                    raise FakeError('server closed the connection')
+        return Cursor()
+
+    def rollback(self):
+        pass
+
+    def reset(self):
+        self.resets += 1
+
+    def close(self):
+        self.closed = 1
+
+
+@pytest.fixture
+def vault(monkeypatch):
+    """ Read secrets from a fake vault, starting with an empty cache """
+    monkeypatch.setitem(sys.modules, 'hvac',
+                        types.SimpleNamespace(Client=FakeVault))
+    monkeypatch.setattr(FakeVault, 'reads', 0)
+    keys = types.SimpleNamespace(access_key='', secret_key='', token='')
+    session = types.SimpleNamespace(get_credentials=lambda: keys)
+    monkeypatch.setattr(credentials.boto3, 'Session', lambda: session)
+    monkeypatch.setattr(credentials, '_SECRETS', {})
+    monkeypatch.setenv('DATASERVICE_PG_SECRET', 'pg')
+    monkeypatch.setenv('ENV', 'test')
+    monkeypatch.delenv('CONN_STR', raising=False)
+
+
+@pytest.fixture
+def database(monkeypatch, vault):
+    """
+    Connect to a fake database with an empty pool
+
+    :returns: The connections `opened`, in order, and the set of passwords
+        the database has `rejected`
+    """
+    opened = []
+    # Passwords the database turns down
+    rejected = set()
+
+    def connect(host=None, dbname=None, user=None, password=None):
+        if password in rejected:
+            raise FakeError('password authentication failed')
+        opened.append(FakeConnection((host, dbname, user, password)))
+        return opened[-1]
+
+    psycopg2 = types.SimpleNamespace(connect=connect,
+                                     OperationalError=FakeError)
+    monkeypatch.setitem(sys.modules, 'psycopg2', psycopg2)
+    monkeypatch.setattr(credentials, '_CONNECTIONS', [])
+    monkeypatch.setattr(credentials, '_ISSUED', {})
+    return types.SimpleNamespace(opened=opened, rejected=rejected)
+
+
+def test_vault_secret(monkeypatch, vault):
+    """
+    Test that vault secrets are reused until most of their lease has passed
+    """
+    now = 1000
+    monkeypatch.setattr(credentials.time, 'time', lambda: now)
+
+    assert credentials.vault_secret('pg')['username'] == 'user1'
+    now = 1079
+    assert credentials.vault_secret('pg')['username'] == 'user1'
+    assert FakeVault.reads == 1
+
+    now = 1081
+    assert credentials.vault_secret('pg')['username'] == 'user2'
+    assert FakeVault.reads == 2
+
+    # Long leases are capped so rotated secrets are still picked up
+    monkeypatch.setattr(FakeVault, 'lease', 24 * 3600)
+    now = 2000
+    assert credentials.vault_secret('pg')['username'] == 'user3'
+    now = 2000 + credentials.SECRET_TTL - 1
+    assert credentials.vault_secret('pg')['username'] == 'user3'
+    now = 2000 + credentials.SECRET_TTL + 1
+    assert credentials.vault_secret('pg')['username'] == 'user4'
+
+
+def test_kms_decrypt(monkeypatch):
+    """ Test that KMS is only asked to decrypt a secret once """
+    calls = []
+
+    def decrypt(CiphertextBlob):
+        calls.append(CiphertextBlob)
+        return {'Plaintext': b'token'}
+
+    kms = types.SimpleNamespace(decrypt=decrypt)
+    monkeypatch.setattr(credentials.boto3, 'client', lambda *a, **k: kms)
+    monkeypatch.setattr(credentials, '_DECRYPTED', {})
+
+    assert credentials.kms_decrypt('c2VjcmV0') == 'token'
+    assert credentials.kms_decrypt('c2VjcmV0') == 'token'
+    assert calls == [b'secret']
+
+
+def test_connection_reuse(database):
+    """ Test that released connections are reset and handed out again """
+    conn = credentials.connect()
+    credentials.release(conn)
+    assert conn.resets == 1 and not conn.closed
+    assert credentials.connect() is conn
+    assert database.opened == [conn]
+
+
+def test_unhealthy_connection(database):
+    """ Test that connections that stopped answering are replaced """
+    conn = credentials.connect()
+    credentials.release(conn)
+    conn.broken = True
+
+    new = credentials.connect()
+    assert new is not conn
+    assert conn.closed
+    assert database.opened == [conn, new]
+
+
+def test_rotated_credentials(monkeypatch, database):
+    """
+    Test that credentials the database turns down are read again, and that
+    idle connections made with rotated credentials are closed
+    """
+    conn = credentials.connect()
+    assert conn.credentials[2:] == ('user1', 'pass1')
+    credentials.release(conn)
+
+    # The password rotates before the cached secret expires, and the
+    # server drops the idle connection
+    database.rejected.add('pass1')
+    conn.broken = True
+    new = credentials.connect()
+    assert new.credentials[2:] == ('user2', 'pass2')
+    assert FakeVault.reads == 2
+    credentials.release(new)
+
+    # The secret expires and is read again with new credentials
+    monkeypatch.setattr(credentials, '_SECRETS', {})
+    latest = credentials.connect()
+    assert latest.credentials[2:] == ('user3', 'pass3')
+    assert new.closed
+    assert credentials._CONNECTIONS == []
+
+
+def test_pool_size(monkeypatch, database):
+    """ Test that no more than POOL_SIZE idle connections are kept open """
+    monkeypatch.setattr(credentials, 'POOL_SIZE', 2)
+    conns = [credentials.connect() for _ in range(3)]
+    assert len(database.opened) == 3
+    for conn in conns:
+        credentials.release(conn)
+    assert [c for _, c in credentials._CONNECTIONS] == conns[:2]
+    assert conns[2].closed
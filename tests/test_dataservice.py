@@ -0,0 +1,68 @@
+from collections import OrderedDict
+
+import pytest
+
+from reports import dataservice
+
+
+@pytest.fixture
+def client(monkeypatch, tmpdir):
+    """
+    A client with an empty cache that answers each url with its path and
+    counts the requests made
+    """
+    monkeypatch.setattr(dataservice, '_CACHE', OrderedDict())
+    monkeypatch.setattr(dataservice, 'CACHE_SIZE', 2)
+    requests = []
+
+    def get(session, url, **kwargs):
+        requests.append(url)
+        return {'url': url}
+    monkeypatch.setattr(dataservice, 'get', get)
+    monkeypatch.setattr(dataservice, 'get_session', lambda size: None)
+
+    client = dataservice.Client('http://ds', cache_dir=str(tmpdir))
+    client.requests = requests
+    return client
+
+
+def test_memory_cache(client, monkeypatch):
+    """
+    Test that the in-memory cache keeps the most recently used responses
+    and drops expired ones
+    """
+    client.cache_dir = None
+    client.get('/a')
+    client.get('/b')
+    client.get('/a')
+    client.get('/c')
+    assert list(dataservice._CACHE) == ['http://ds/a', 'http://ds/c']
+    client.get('/a')
+    assert client.requests == ['http://ds/a', 'http://ds/b', 'http://ds/c']
+
+    now = dataservice.time.time() + client.ttl + 1
+    monkeypatch.setattr(dataservice.time, 'time', lambda: now)
+    client.get('/a')
+    assert list(dataservice._CACHE) == ['http://ds/a']
+    assert client.requests[-1] == 'http://ds/a'
+
+
+def test_disk_cache(client, tmpdir):
+    """
+    Test that responses cached on disk are reused, and corrupt cache files
+    are treated as misses and replaced
+    """
+    assert client.get('/a') == {'url': 'http://ds/a'}
+    dataservice._CACHE.clear()
+    assert client.get('/a') == {'url': 'http://ds/a'}
+    assert len(client.requests) == 1
+
+    [path] = tmpdir.listdir()
+    path.write('[1e12, {"url": "trunc')
+    dataservice._CACHE.clear()
+    assert client.get('/a') == {'url': 'http://ds/a'}
+    assert len(client.requests) == 2
+    assert [p.basename for p in tmpdir.listdir()] == [path.basename]
+    dataservice._CACHE.clear()
+    assert client.get('/a') == {'url': 'http://ds/a'}
+    assert len(client.requests) == 2
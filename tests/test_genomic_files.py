@@ -0,0 +1,97 @@
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+
+from reports import genomic_files, dataservice
+from tests.test_counts import FakeApi, dataservice_db
+
+# The totals the api gives for genomic files filtered by study and data type
+API_TOTALS = {
+    'SD_1': {'Aligned Reads': 2, 'gVCF': 1},
+    'SD_2': {'Aligned Reads': 1},
+    'SD_3': {},
+}
+
+
+def test_by_study_sql(dataservice_db):
+    """
+    Test that the sql backend counts the same genomic files as the api,
+    counting files sequenced from many biospecimens once
+    """
+    data_types = ['Aligned Reads', 'Unaligned Reads', 'gVCF', 'Other']
+    client = FakeApi(lambda endpoint, params:
+                     API_TOTALS[params['study_id']]
+                     .get(params['data_type'], 0))
+    expected = genomic_files.by_study(client, '/genomic-files',
+                                      list(API_TOTALS), data_types)
+
+    result = genomic_files.by_study_sql(dataservice_db, data_types)
+
+    assert list(result) == ['SD_1', 'SD_2', 'SD_3']
+    assert result == expected
+
+
+# The data types of each study's genomic files, as paged through the api
+STUDY_FILES = {
+    'SD_1': ['Aligned Reads', 'gVCF', 'Aligned Reads', None, 'Aligned Reads'],
+    'SD_2': ['Aligned Reads', 'Weird Type'],
+    'SD_3': [],
+}
+
+
+@pytest.fixture
+def paged_client(monkeypatch):
+    """
+    A dataservice client paging through STUDY_FILES two files at a time,
+    with a `next` link after every page like the dataservice gives
+
+    The urls requested are kept in `client.requests`.
+    """
+    monkeypatch.setattr(dataservice, '_CACHE', OrderedDict())
+    monkeypatch.setattr(dataservice, 'get_session', lambda size: None)
+    monkeypatch.setattr(dataservice, 'PAGE_SIZE', 2)
+    requests = []
+
+    def get(session, url, **kwargs):
+        requests.append(url)
+        parsed = urlparse(url)
+        params = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+        files = STUDY_FILES[params['study_id']]
+        after = int(params.get('after', 0))
+        limit = int(params['limit'])
+        next_url = (f'{parsed.path[len("/ds"):]}?limit={limit}'
+                    f'&study_id={params["study_id"]}&after={after + limit}')
+        return {'results': [{'data_type': d}
+                            for d in files[after:after + limit]],
+                '_links': {'next': next_url}}
+    monkeypatch.setattr(dataservice, 'get', get)
+
+    client = dataservice.Client('http://host/ds', concurrency=2)
+    client.requests = requests
+    return client
+
+
+def test_paginate(paged_client):
+    """ Test that pages are followed until one comes back empty """
+    url = '/genomic-files?limit=2&study_id=SD_1'
+    types = [gf['data_type'] for gf in paged_client.paginate(url)]
+    assert types == STUDY_FILES['SD_1']
+    # Three pages of files and the empty page that ends them
+    assert len(paged_client.requests) == 4
+    assert paged_client.requests[-1].endswith('after=6')
+
+
+def test_by_study_faceted(paged_client):
+    """ Test that every data type found in each study's files is counted """
+    data_types, counts = genomic_files.by_study_faceted(
+        paged_client, '/genomic-files', list(STUDY_FILES),
+        ['Aligned Reads', 'Unaligned Reads', 'gVCF'])
+
+    assert data_types == ['Aligned Reads', 'Unaligned Reads', 'gVCF',
+                          'None', 'Weird Type']
+    assert counts == {'SD_1': [3, 0, 1, 1, 0],
+                      'SD_2': [1, 0, 0, 0, 1],
+                      'SD_3': [0, 0, 0, 0, 0]}
+    # Each study ends on an empty page, or has no files at all
+    assert len(paged_client.requests) == 4 + 2 + 1
@@ -0,0 +1,101 @@
+from reports import snapshot, storage
+from reports.history import History
+from reports.storage import MemoryStorage, get_storage
+from reports.change_report import ChangeGenerator, handler
+from tests.test_change_report import summary_files
+
+
+# The `summary` of the biospecimens table in each test summary
+DESCRIBE = {
+    'summary_1': b',composition\ncount,31\nunique,2\ntop,Blood\n',
+    'summary_2': b',composition\ncount,48\nunique,3\ntop,Blood\n',
+}
+
+
+def summary_counts(name, describe=False):
+    """
+    Get the value counts of a test summary as they are in a snapshot, and
+    the summaries of its tables too if `describe`
+    """
+    files = summary_files(name)
+    if describe:
+        files['biospecimens']['summary'] = DESCRIBE[name]
+        return snapshot.to_snapshot(files)
+    return snapshot.to_snapshot(files)[0]
+
+
+def test_history():
+    """ Test that summaries are appended to and looked up in the history """
+    history = History(MemoryStorage())
+    history.append('20190101', summary_counts('summary_1'))
+    history.append('20190102', summary_counts('summary_2'))
+
+    assert history.tables() == ['biospecimens', 'diagnoses', 'participants']
+    assert history.dates('biospecimens') == ['20190101', '20190102']
+    assert history.dates('diagnoses') == ['20190102']
+
+    counts = history.counts('biospecimens', '20190102', 'composition')
+    assert counts[counts['value'] == 'Blood']['count'].iloc[0] == 16
+    assert history.counts('diagnoses', '20190101') is None
+    assert list(history.between('biospecimens', '20190102', '20190105')) == \
+        ['20190102']
+
+    assert history.first_seen('biospecimens', 'composition', 'Blood') == \
+        '20190101'
+    assert history.first_seen('diagnoses', 'diagnosis_category',
+                              'Cancer') == '20190102'
+    assert history.first_seen('biospecimens', 'composition', 'nope') is None
+
+
+def test_history_change_report():
+    """ Test that summaries from the history diff like the originals """
+    history = History(MemoryStorage())
+    history.append('20190101', summary_counts('summary_1'))
+    history.append('20190102', summary_counts('summary_2'))
+
+    g = ChangeGenerator(history.summary('20190101'),
+                        history.summary('20190102'), output=MemoryStorage())
+    expected = ChangeGenerator('tests/data/change_report/summary_1/',
+                               'tests/data/change_report/summary_2/',
+                               output=MemoryStorage())
+    assert g.compute_diffs()[1] == expected.compute_diffs()[1]
+
+
+def test_history_describe():
+    """ Test that the summaries of tables are kept in the history """
+    history = History(MemoryStorage())
+    history.append('20190101', *summary_counts('summary_1', describe=True))
+    history.append('20190102', *summary_counts('summary_2', describe=True))
+
+    assert history.dates('biospecimens') == ['20190101', '20190102']
+    summary = history.summary('20190101')
+    assert summary.read('biospecimens/summary.csv') == DESCRIBE['summary_1']
+    assert summary.list('participants') == ['gender.csv']
+
+    g = ChangeGenerator(summary, history.summary('20190102'),
+                        output=MemoryStorage())
+    tables, _ = g.compute_diffs()
+    assert 'summary' in tables['biospecimens']
+
+
+def test_history_fallback(monkeypatch):
+    """ Test that the change report falls back to the summary paths for
+    dates missing from the history """
+    # Keep the named in-memory history and output to this test
+    monkeypatch.setattr(storage, '_MEMORY', {})
+    history = History(get_storage('memory://history'))
+    history.append('20190102', summary_counts('summary_2'))
+    assert list(history.summary('20190101').list()) == []
+
+    event = {
+        'history': 'memory://history',
+        'date_1': '20190101',
+        'date_2': '20190102',
+        'summary_path_1': 'tests/data/change_report/summary_1/',
+        'summary_path_2': 'tests/data/does_not_exist/',
+        'output': 'change_report',
+        'local_output': 'memory://history_change_report',
+        'title': 'Change Report',
+    }
+    message, files = handler(event, {})
+    assert 'diffs/biospecimens/composition_diff.csv' in files
@@ -1,5 +1,12 @@
+import sys
+import json
+import subprocess
 import pytest
+import boto3
 import service
+from moto import mock_s3
+
+from reports.storage import get_storage
 
 
 def test_handler():
@@ -7,3 +14,83 @@ def test_handler():
     Test the service handler
     """
     service.handler({}, {})
+
+
+@mock_s3
+def test_upload_files(tmpdir):
+    """
+    Test uploading many files at once, where one of them fails
+    """
+    s3 = boto3.client('s3', region_name='us-east-1')
+    s3.create_bucket(Bucket='bkt')
+    paths = []
+    for name in ['report.html', 'counts.csv', 'figure.png', 'state.pkl.gz']:
+        path = tmpdir.join(name)
+        path.write('data')
+        paths.append(str(path))
+    missing = str(tmpdir.join('missing.csv'))
+
+    failures = service.upload_files(paths + [missing], 'bkt/today', client=s3)
+    assert [path for path, _ in failures] == [missing]
+
+    prefix = 'today/' + str(tmpdir).replace('/tmp/', '')
+    types = {name: s3.head_object(Bucket='bkt', Key=f'{prefix}/{name}')
+                     ['ContentType']
+             for name in ['report.html', 'counts.csv', 'figure.png',
+                          'state.pkl.gz']}
+    assert types == {'report.html': 'text/html',
+                     'counts.csv': 'text/csv',
+                     'figure.png': 'image/png',
+                     'state.pkl.gz': 'application/gzip'}
+
+
+@mock_s3
+def test_upload_unchanged(tmpdir, monkeypatch):
+    """
+    Test that files unchanged since the previous run are copied in s3, and
+    that text files are stored gzipped
+    """
+    s3 = boto3.client('s3', region_name='us-east-1')
+    s3.create_bucket(Bucket='bkt')
+    uploaded = []
+    upload_to_s3 = service.upload_to_s3
+    monkeypatch.setattr(service, 'upload_to_s3', lambda path, *args:
+                        uploaded.append(path) or upload_to_s3(path, *args))
+
+    tmpdir.join('same.csv').write('a,b\n1,2\n')
+    tmpdir.join('changed.html').write('<p>1</p>')
+    paths = [str(tmpdir.join('same.csv')), str(tmpdir.join('changed.html'))]
+    service.upload_files(paths, 'bkt/20200101-reports/Test', client=s3)
+    assert sorted(uploaded) == sorted(paths)
+
+    uploaded.clear()
+    tmpdir.join('changed.html').write('<p>2</p>')
+    assert service.upload_files(paths, 'bkt/20200102-reports/Test',
+                                client=s3) == []
+    assert uploaded == [paths[1]]
+
+    storage = get_storage('s3://bkt/20200102-reports/Test')
+    storage.client = s3
+    name = str(tmpdir).replace('/tmp/', '')
+    resp = s3.get_object(Bucket='bkt',
+                         Key=f'20200102-reports/Test/{name}/same.csv')
+    assert 'gzip' in resp['ContentEncoding'].split(',')
+    assert resp['ContentType'] == 'text/csv'
+    assert storage.read(f'{name}/same.csv') == b'a,b\n1,2\n'
+    assert storage.read(f'{name}/changed.html') == b'<p>2</p>'
+    manifest = json.loads(storage.read(service.MANIFEST_FILE))
+    assert set(manifest) == {f'{name}/same.csv', f'{name}/changed.html'}
+
+
+@pytest.mark.parametrize('module', ['service', 'reports.sql_report'])
+def test_light_imports(module):
+    """
+    Test that the service and light reports don't import the heavy
+    dependencies of other reports on a cold start
+    """
+    heavy = ['pandas', 'matplotlib', 'hvac', 'sqlalchemy']
+    out = subprocess.check_output([
+        sys.executable, '-c',
+        f'import sys, {module}; print([m for m in {heavy} '
+        f'if m in sys.modules])'], universal_newlines=True)
+    assert out.strip() == '[]'
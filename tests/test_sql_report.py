@@ -0,0 +1,52 @@
+import pytest
+
+from reports.storage import MemoryStorage
+from reports.sql_report import normalize, ResultCache, snapshot_connections
+
+
+def test_normalize():
+    assert (normalize("SELECT  *\n  FROM study\nWHERE name = 'a  b' ;") ==
+            "SELECT * FROM study WHERE name = 'a  b'")
+
+
+def test_result_cache():
+    output = MemoryStorage('sql_report_output')
+    output.write('report.csv', 'count\n1\n')
+    cache = ResultCache(MemoryStorage(), ttl=60)
+
+    key = cache.key('select count(*) from study', 'copy', False)
+    assert key == cache.key('select count(*)\n  from study;', 'copy', False)
+    assert key != cache.key('select count(*) from study', 'cursor', False)
+    assert not cache.copy(key, output, 'cached.csv')
+
+    cache.add(key, output, 'report.csv')
+    assert cache.copy(key, output, 'cached.csv')
+    assert output.read('cached.csv') == b'count\n1\n'
+
+    cache.ttl = -1
+    cache.add(key, output, 'report.csv')
+    assert not cache.copy(key, output, 'expired.csv')
+
+
+def test_snapshot_connections_release():
+    """
+    Test that connections already opened are released when a later one
+    can't be opened
+    """
+    opened = []
+    released = []
+
+    class Connection:
+        def set_session(self, **kwargs):
+            pass
+
+    def connect():
+        if len(opened) == 2:
+            raise IOError('too many connections')
+        opened.append(Connection())
+        return opened[-1]
+
+    with pytest.raises(IOError):
+        snapshot_connections(connect, released.append, 3)
+    assert released == opened
+    assert len(released) == 2
@@ -0,0 +1,353 @@
+import json
+import sqlite3
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from reports import summary_report, trend_report
+from reports.storage import MemoryStorage
+
+
+@pytest.fixture
+def df():
+    return pd.DataFrame({
+        'kf_id': ['PT_{}'.format(i) for i in range(7)],
+        'gender': ['Male', 'Female', 'Male', None, 'Male', 'Female', None],
+        'age': [10, 20, 20, 30, 40, 40, 40],
+        'weight': [1.5, np.nan, 2.5, 2.5, np.nan, 4.0, 0.5],
+        'is_proband': [True, False, False, True, False, False, False],
+        'family_id': ['FM_1', 'FM_1', 'FM_2', 'FM_2', 'FM_2', None, None],
+    })
+
+
+def test_counts_report(df):
+    """ Test that summaries from value counts match those from the table """
+    expected = summary_report.table_report(df)
+    counts = {c: summary_report.column_report(df, c)
+              for c in df.columns if c not in summary_report.IGNORE_COLS}
+    reports = summary_report.counts_report(counts)
+
+    assert list(reports.keys()) == list(expected.keys())
+    assert reports['summary'].to_csv() == expected['summary'].to_csv()
+    for name in expected:
+        assert reports[name].to_csv() == expected[name].to_csv()
+
+
+# Postgres types of the columns of the test table
+SCHEMA = [('kf_id', 'character varying'), ('gender', 'character varying'),
+          ('age', 'integer'), ('weight', 'double precision'),
+          ('is_proband', 'boolean'), ('family_id', 'character varying'),
+          ('score', 'integer'), ('ethnicity', 'character varying')]
+
+
+def postgres_text(value):
+    """ Get the text postgres casts a value to """
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, float):
+        return repr(value)[:-2] if repr(value).endswith('.0') \
+            else repr(value)
+    return str(value)
+
+
+def fake_read_sql(df, queries):
+    """
+    Answer the queries of `pushdown_counts` from a dataframe the way
+    postgres would, with every value cast to text
+    """
+    def read_sql_query(sql, con, params=None):
+        queries.append(sql)
+        if 'information_schema.columns' in sql:
+            return pd.DataFrame(SCHEMA, columns=['column_name', 'data_type'])
+
+        columns = [c for c, _ in SCHEMA
+                   if c not in summary_report.IGNORE_COLS]
+        records = []
+        for i, col in enumerate(columns):
+            values = [postgres_text(None if pd.isnull(v) else
+                                    v.item() if hasattr(v, 'item') else v)
+                      for v in df[col]]
+            for value in dict.fromkeys(values):
+                records.append({'k': i, 'v': value,
+                                'count': values.count(value),
+                                'first': values.index(value) + 1})
+        # Groups come back in no particular order
+        return pd.DataFrame.from_records(records[::-1])
+    return read_sql_query
+
+
+def test_pushdown_counts(df, monkeypatch):
+    """
+    Test that value counts computed in postgres summarize the same as the
+    table read whole, including the dtypes of columns with nulls and the
+    top value of ties
+    """
+    # An integer column with nothing but nulls is read as objects
+    df['score'] = pd.Series([None] * len(df), dtype=object)
+    # Tied values, the first seen of which isn't the first in order
+    df['ethnicity'] = ['b', 'a', 'a', 'b', None, 'c', 'c']
+    queries = []
+    monkeypatch.setattr(summary_report.pd, 'read_sql_query',
+                        fake_read_sql(df, queries))
+
+    counts = summary_report.pushdown_counts('participant', 'con')
+    reports = summary_report.counts_report(counts)
+    expected = summary_report.table_report(df)
+
+    assert 'table_schema = current_schema()' in queries[0]
+    assert 'LATERAL (VALUES (0, t."gender"::text), (1, t."age"::text)' in \
+        queries[1]
+    assert expected['summary'].loc['top', 'ethnicity'] == 'b'
+    assert list(reports) == list(expected)
+    for name in expected:
+        assert reports[name].to_csv() == expected[name].to_csv()
+        assert reports[name].dtypes.equals(expected[name].dtypes)
+
+
+def test_chunked_counts_null_chunk(tmpdir):
+    """
+    Test that a chunk where a column is all null doesn't change the dtype
+    of its merged value counts, and that ties across chunks have the same
+    top value as the whole table
+    """
+    path = str(tmpdir.join('dataservice.db'))
+    con = f'sqlite:///{path}'
+    db = sqlite3.connect(path)
+    db.execute('CREATE TABLE participant (kf_id TEXT, age INTEGER, '
+               'weight REAL, is_proband BOOLEAN, gender TEXT)')
+    # The second chunk of three rows has nothing but nulls
+    db.executemany('INSERT INTO participant VALUES (?, ?, ?, ?, ?)', [
+        ('PT_1', 10, 1.5, True, 'Male'),
+        ('PT_2', 20, 2.5, False, 'Female'),
+        ('PT_3', 10, None, True, 'Male'),
+        ('PT_4', None, None, None, None),
+        ('PT_5', None, None, None, None),
+        ('PT_6', None, None, None, None),
+        ('PT_7', 30, 0.5, False, 'Female'),
+        ('PT_8', 30, 0.5, False, 'Alien'),
+        ('PT_9', 40, 4.0, True, 'Alien'),
+    ])
+    db.commit()
+    db.close()
+    expected = summary_report.table_report(pd.read_sql_table('participant',
+                                                             con))
+
+    counts = summary_report.chunked_counts('participant', con, chunksize=3)
+    reports = summary_report.counts_report(counts)
+
+    assert expected['summary'].loc['top', 'gender'] == 'Male'
+
+    assert list(reports) == list(expected)
+    for name in expected:
+        assert reports[name].to_csv() == expected[name].to_csv()
+        assert reports[name].dtypes.equals(expected[name].dtypes)
+
+
+def test_handler_date(monkeypatch):
+    """
+    Test that the date is only read from the output when the history needs
+    it, so outputs that aren't dated still work
+    """
+    made = []
+
+    class Generator:
+        def __init__(self, **kwargs):
+            self.kwargs = kwargs
+            self.storage = MemoryStorage()
+            made.append(self)
+
+        def make_report(self):
+            pass
+
+    monkeypatch.setattr(summary_report, 'SummaryGenerator', Generator)
+    monkeypatch.setattr(summary_report.credentials, 'pg_connection_str',
+                        lambda: 'postgres://')
+
+    summary_report.handler({'output': 'bkt/today/Table_Summary/'}, None)
+    assert made[-1].kwargs['date'] == datetime.now().strftime('%Y%m%d')
+    assert made[-1].kwargs['history'] is None
+
+    summary_report.handler({'output': 'bkt/20190102-reports/Table_Summary/',
+                            'history': True}, None)
+    assert made[-1].kwargs['date'] == '20190102'
+    assert made[-1].kwargs['history'] == 's3://bkt/history'
+
+
+def test_handler_trend_report(monkeypatch):
+    """
+    Test that the trend report is only started once the summary is saved,
+    and trends the week up to and including it
+    """
+    events = []
+
+    class Generator:
+        def __init__(self, **kwargs):
+            self.storage = MemoryStorage()
+
+        def make_report(self):
+            events.append('summary')
+
+    class Lambda:
+        def invoke(self, FunctionName, InvocationType, Payload):
+            events.append(json.loads(Payload))
+
+    monkeypatch.setattr(summary_report, 'SummaryGenerator', Generator)
+    monkeypatch.setattr(summary_report.credentials, 'pg_connection_str',
+                        lambda: 'postgres://')
+    monkeypatch.setattr(summary_report.boto3, 'client',
+                        lambda service: Lambda())
+
+    context = type('Context', (), {'function_name': 'reports'})
+    summary_report.handler({'output': 'bkt/20190107-reports/Table_Summary/',
+                            'history': True, 'trend_report': True}, context)
+    assert events[0] == 'summary'
+    payload = events[1]
+    assert payload['module'] == 'reports.trend_report'
+    assert payload['output'] == 'bkt/20190107-reports/Weekly_Trend'
+    assert payload['history']
+    paths = trend_report.summary_paths(payload, payload['output'])
+    assert list(paths) == [f'2019010{d}' for d in range(1, 8)]
+    assert paths['20190107'] == \
+        's3://bkt/20190107-reports/Table_Summary/summaries'
+
+
+@pytest.fixture
+def database(tmpdir, monkeypatch):
+    """
+    A sqlite database with a few dataservice tables, which are the only
+    tables summarized, and a fixed fingerprint for each table
+    """
+    path = str(tmpdir.join('dataservice.db'))
+    con = f'sqlite:///{path}'
+    db = sqlite3.connect(path)
+    db.execute('CREATE TABLE participant (kf_id TEXT, age INTEGER, '
+               'gender TEXT, is_proband BOOLEAN, family_id TEXT)')
+    db.executemany('INSERT INTO participant VALUES (?, ?, ?, ?, ?)', [
+        (f'PT_{i}', i % 7 or None, ['Male', 'Female', None][i % 3],
+         i % 2 == 0, f'FM_{i % 5}') for i in range(50)])
+    db.execute('CREATE TABLE biospecimen (kf_id TEXT, volume REAL, '
+               'composition TEXT, participant_id TEXT)')
+    db.executemany('INSERT INTO biospecimen VALUES (?, ?, ?, ?)', [
+        (f'BS_{i}', i / 4, ['Blood', 'Saliva'][i % 2], f'PT_{i % 50}')
+        for i in range(80)])
+    db.execute('CREATE TABLE outcome (kf_id TEXT, vital_status TEXT)')
+    db.commit()
+    db.close()
+    monkeypatch.setattr(summary_report, 'TABLES',
+                        ['participant', 'biospecimen', 'outcome'])
+    monkeypatch.setattr(summary_report, 'fingerprint',
+                        lambda table, con: {'rows': 0})
+    return con
+
+
+@pytest.mark.parametrize('method', ['table', 'chunked'])
+def test_parallel_report(database, monkeypatch, method):
+    """
+    Test that summarizing tables in parallel saves exactly the same files
+    as summarizing them one at a time
+    """
+    class Datetime(datetime):
+        @classmethod
+        def now(cls):
+            return datetime(2019, 1, 2, 3, 4, 5)
+
+    monkeypatch.setattr(summary_report, 'datetime', Datetime)
+
+    outputs = []
+    for workers in [1, 3]:
+        storage = MemoryStorage()
+        g = summary_report.SummaryGenerator(output=storage, conn_str=database,
+                                            method=method, chunksize=20,
+                                            workers=workers, snapshot=True)
+        g.make_report()
+        outputs.append(storage.files)
+
+    serial, parallel = outputs
+    assert 'summaries/participant/gender.csv' in serial
+    assert list(parallel) == list(serial)
+    for path, data in serial.items():
+        assert parallel[path] == data, path
+
+
+def test_fingerprint(monkeypatch):
+    """
+    Test that a table's fingerprint changes with its rows, modification, and
+    columns
+    """
+    stats = {'rows': 3, 'modified_at': pd.Timestamp('2019-01-02 03:04:05')}
+    schema = list(SCHEMA)
+
+    def read_sql_query(sql, con, params=None):
+        if 'information_schema.columns' in sql:
+            return pd.DataFrame(schema, columns=['column_name', 'data_type'])
+        return pd.DataFrame([stats])
+
+    monkeypatch.setattr(summary_report.pd, 'read_sql_query', read_sql_query)
+
+    first = summary_report.fingerprint('participant', 'con')
+    assert first['rows'] == 3
+    assert first['modified_at'] == '2019-01-02 03:04:05'
+    assert summary_report.fingerprint('participant', 'con') == first
+
+    stats['modified_at'] = pd.Timestamp('2019-01-03')
+    modified = summary_report.fingerprint('participant', 'con')
+    assert modified['modified_at'] != first['modified_at']
+    assert modified['columns'] == first['columns']
+
+    schema[1] = ('gender', 'text')
+    assert summary_report.fingerprint('participant', 'con')['columns'] != \
+        modified['columns']
+
+
+def test_reuse_unchanged(database, monkeypatch):
+    """
+    Test that unchanged tables reuse the summaries of the previous report,
+    but only if it was made with the same method for the same study
+    """
+    previous = MemoryStorage()
+    summary_report.SummaryGenerator(output=previous, conn_str=database,
+                                    study_id='SD_1').make_report()
+    state = json.loads(previous.read('SD_1/fingerprints.json'))
+    assert state['prefix'] == 'SD_1/'
+    assert state['method'] == 'table'
+    assert state['tables']['participant'] == {'rows': 0}
+
+    summarized = []
+    summarize = summary_report.SummaryGenerator.summarize
+    monkeypatch.setattr(summary_report.SummaryGenerator, 'summarize',
+                        lambda self, table, pool=None:
+                        summarized.append(table) or
+                        summarize(self, table, pool))
+
+    storage = MemoryStorage()
+    summary_report.SummaryGenerator(output=storage, conn_str=database,
+                                    study_id='SD_1',
+                                    previous=previous).make_report()
+    assert summarized == []
+    for path, data in previous.files.items():
+        if '/summaries/' in path:
+            assert storage.read(path) == data, path
+
+    for kwargs in [{'study_id': 'SD_1', 'method': 'chunked'},
+                   {'study_id': 'SD_2'}, {}]:
+        del summarized[:]
+        summary_report.SummaryGenerator(output=MemoryStorage(),
+                                        conn_str=database, previous=previous,
+                                        **kwargs).make_report()
+        assert summarized == list(summary_report.TABLES), kwargs
+
+    # A previous report made without a study isn't reused for a study
+    previous = MemoryStorage()
+    summary_report.SummaryGenerator(output=previous,
+                                    conn_str=database).make_report()
+    previous.write('SD_1/fingerprints.json',
+                   previous.read('fingerprints.json'))
+    del summarized[:]
+    summary_report.SummaryGenerator(output=MemoryStorage(), conn_str=database,
+                                    study_id='SD_1',
+                                    previous=previous).make_report()
+    assert summarized == list(summary_report.TABLES)
@@ -0,0 +1,79 @@
+from reports import trend_report, snapshot
+from reports.storage import MemoryStorage
+from tests.test_change_report import summary_files, memory_summary
+
+
+def summary(name, as_snapshot=False):
+    """ Save a test summary to an in-memory storage """
+    files = summary_files(name)
+    if not as_snapshot:
+        return memory_summary(files)
+    storage = MemoryStorage()
+    for name, data in snapshot.snapshot_files(files).items():
+        storage.write(name, data)
+    return storage
+
+
+def test_trend():
+    """ Test that changes are totalled across many summaries """
+    summaries = {
+        '20190101': summary('summary_1'),
+        '20190102': summary('summary_2', as_snapshot=True),
+        '20190103': summary('summary_1'),
+        '20190104': MemoryStorage(),
+    }
+    output = MemoryStorage()
+    g = trend_report.TrendGenerator(summaries, output=output)
+    g.make_report()
+    assert 'trend_report.html' in output.files
+
+    counts = {label: trend_report.load_counts(s)
+              for label, s in list(summaries.items())[:3]}
+    wide = trend_report.align_counts(counts)
+    assert list(wide.columns) == ['20190101', '20190102', '20190103']
+    trends, totals = trend_report.trend_tables(wide)
+
+    blood = trends[('biospecimens', 'composition')]
+    blood = blood[blood['composition'] == 'Blood'].iloc[0]
+    assert list(blood[['20190101', '20190102', '20190103']]) == [1, 16, 1]
+    assert blood['net'] == 0
+    assert blood['gross'] == 30
+
+    composition = totals['biospecimens']
+    composition = composition[composition['column'] == 'composition']
+    assert composition['net'].iloc[0] == 0
+    assert composition['gross'].iloc[0] == 2 * 2038
+
+
+def test_summary_paths():
+    """ Test that a date range is turned into the summaries of each day """
+    paths = trend_report.summary_paths(
+        {'days': 3}, 'bucket/20190103-reports/Weekly_Trend')
+    assert paths == {
+        '20190101': 's3://bucket/20190101-reports/Table_Summary/summaries',
+        '20190102': 's3://bucket/20190102-reports/Table_Summary/summaries',
+        '20190103': 's3://bucket/20190103-reports/Table_Summary/summaries',
+    }
+
+
+def test_history_fallback(monkeypatch):
+    """
+    Test that days missing from the history fall back to their summary
+    paths
+    """
+    history = MemoryStorage()
+    trend_report.History(history).append(
+        '20190103', trend_report.load_counts(summary('summary_1')))
+    monkeypatch.setattr(trend_report, 'history_path', lambda output: history)
+    made = []
+    monkeypatch.setattr(trend_report.TrendGenerator, 'make_report',
+                        lambda self: made.append(self))
+
+    trend_report.handler({'days': 2, 'history': True,
+                          'output': 'bucket/20190103-reports/Weekly_Trend'},
+                         None)
+    summaries = made[0].summaries
+    assert list(summaries) == ['20190102', '20190103']
+    assert summaries['20190102'] == \
+        's3://bucket/20190102-reports/Table_Summary/summaries'
+    assert 'biospecimens/' in summaries['20190103'].list()
@@ -0,0 +1,37 @@
+import os
+import pytest
+
+from reports.workspace import Workspace, WorkspaceFull
+
+
+def test_workspace(tmpdir):
+    """
+    Test that a workspace lists only its own files and is removed after
+    """
+    root = str(tmpdir)
+    stale = Workspace(root=root)
+    with open(stale.file('old.png'), 'w') as f:
+        f.write('old')
+    tmpdir.join('other.csv').write('not ours')
+
+    with Workspace(root=root, budget=10) as workspace:
+        assert not os.path.exists(stale.path)
+        with open(workspace.file('figures/plot.png'), 'w') as f:
+            f.write('png')
+        with open(workspace.file('tables/table.csv'), 'w') as f:
+            f.write('a,b\n')
+        assert [workspace.name(p) for p in workspace.files('.png')] == \
+            ['figures/plot.png']
+        assert len(workspace.files()) == 2
+        assert workspace.usage() == 7
+
+        with open(workspace.file('big.csv'), 'w') as f:
+            f.write('0123456789')
+        with pytest.raises(WorkspaceFull):
+            workspace.file('more.csv')
+
+        assert Workspace.from_event({'workspace': workspace.path}).path == \
+            workspace.path
+
+    assert not os.path.exists(workspace.path)
+    assert tmpdir.join('other.csv').check()